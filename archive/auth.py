@@ -1,18 +1,113 @@
+import fcntl
+import json
+import os
+import tempfile
 import time
+from contextlib import contextmanager
+from pathlib import Path
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Файловый кэш токена: общий для всех процессов ETL (update_all, отдельные шаги),
+# чтобы не ходить за новым токеном в каждом запуске.
+TOKEN_CACHE_PATH = Path(
+    os.getenv(
+        "OZON_PERF_TOKEN_CACHE",
+        str(Path.home() / ".cache" / "purr-analytics" / "perf_token.json"),
+    )
+)
+
+# Обновляем токен заранее, за минуту до истечения
+EXPIRY_SKEW_SEC = 60
+
+# Одна сессия на процесс: keep-alive и пул соединений к api-performance.ozon.ru,
+# чтобы запросы токена и API не делали TLS-handshake каждый раз.
+# Запрос токена идемпотентен, поэтому ретраим и POST.
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(["GET", "POST"]),
+        ),
+    ),
+)
+
+
+def get_session() -> requests.Session:
+    """Общая HTTP-сессия для запросов к Performance API (токен + методы API)."""
+    return _SESSION
+
 
 class PerformanceAuth:
-    def __init__(self, client_id, client_secret):
+    def __init__(self, client_id, client_secret, cache_path: Path = TOKEN_CACHE_PATH):
         self.client_id = client_id
         self.client_secret = client_secret
+        self.cache_path = Path(cache_path)
         self.token = None
         self.expires_at = 0
 
-    def get_token(self) -> str:
-        if self.token and time.time() < self.expires_at - 60:
-            return self.token
+    def _is_fresh(self, expires_at: float) -> bool:
+        return time.time() < expires_at - EXPIRY_SKEW_SEC
+
+    @contextmanager
+    def _file_lock(self):
+        """
+        Эксклюзивная блокировка на время чтения/обновления кэша:
+        параллельные процессы не запрашивают токен одновременно, а ждут и берут из файла.
+        """
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        lock_path = self.cache_path.with_suffix(".lock")
+        with open(lock_path, "w") as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def _load_cached(self) -> bool:
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
 
-        r = requests.post(
+        if str(data.get("client_id")) != str(self.client_id):
+            return False
+        if not data.get("access_token") or not self._is_fresh(float(data.get("expires_at") or 0)):
+            return False
+
+        self.token = data["access_token"]
+        self.expires_at = float(data["expires_at"])
+        return True
+
+    def _save_cached(self) -> None:
+        payload = {
+            "client_id": str(self.client_id),
+            "access_token": self.token,
+            "expires_at": self.expires_at,
+        }
+        # атомарно: пишем во временный файл рядом и подменяем через os.replace
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_path.parent, prefix=".perf_token.")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(payload, f)
+            os.chmod(tmp_path, 0o600)  # там секрет
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _request_token(self) -> None:
+        r = _SESSION.post(
             "https://api-performance.ozon.ru/api/client/token",
             json={
                 "client_id": self.client_id,
@@ -26,4 +121,22 @@ class PerformanceAuth:
         data = r.json()
         self.token = data["access_token"]
         self.expires_at = time.time() + int(data["expires_in"])
+
+    def get_token(self) -> str:
+        # L1: токен в памяти процесса
+        if self.token and self._is_fresh(self.expires_at):
+            return self.token
+
+        # L2: файловый кэш, общий для процессов
+        with self._file_lock():
+            if self._load_cached():
+                return self.token
+
+            self._request_token()
+            try:
+                self._save_cached()
+            except OSError as e:
+                # кэш — только оптимизация, без него тоже работаем
+                print(f"[auth] не удалось сохранить кэш токена: {e}")
+
         return self.token
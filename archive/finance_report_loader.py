@@ -1,99 +1,182 @@
 # src/finance_report_loader.py
 
+import io
 import re
 import pandas as pd
-from decimal import Decimal
-from typing import Optional
 
-from .db import execute_query
+import psycopg2
+from psycopg2.extras import execute_values
+
+from .db import get_cursor
 from .etl import recalc_orders_finance  # ты уже добавил эту функцию
 
 POSTING_RE = re.compile(r"^\d+-\d+-\d+$")
 
+REQUIRED_COLUMNS = [
+    "ID начисления",
+    "Дата начисления",
+    "Группа услуг",
+    "Тип начисления",
+    "SKU",
+    "Дата принятия заказа в обработку или оказания услуги",
+    "Сумма итого, руб.",
+]
+OPTIONAL_COLUMNS = ["Вознаграждение Ozon, %"]
+
+# Текстовые колонки читаем сразу как string, остальное pandas не угадывает заново
+TEXT_DTYPES = {
+    "ID начисления": "string",
+    "Группа услуг": "string",
+    "Тип начисления": "string",
+}
+
+# Колонки, которые уходят в COPY/INSERT (в этом порядке)
+INSERT_COLUMNS = [
+    "order_id",
+    "fee_group",
+    "fee_name",
+    "amount",
+    "percent",
+    "product_id",
+    "sku",
+    "occurred_at",
+    "operation_type",
+    "source",
+]
+
+SOURCE = "finance_report"
+
+# \N — маркер NULL, чтобы пустая строка оставалась пустой строкой
+COPY_SQL = (
+    f"COPY order_fee_items ({', '.join(INSERT_COLUMNS)}) "
+    "FROM STDIN WITH (FORMAT CSV, NULL '\\N')"
+)
+
+
+def _excel_engine() -> str:
+    """
+    calamine (Rust) читает xlsx в разы быстрее и экономнее openpyxl.
+    Если python-calamine не установлен — откатываемся на openpyxl.
+    """
+    try:
+        import python_calamine  # noqa: F401
+        return "calamine"
+    except ImportError:
+        return "openpyxl"
+
+
+def _read_report(path: str) -> pd.DataFrame:
+    # В отчёте первая строка = "Период: ....", заголовки начинаются со 2-й строки.
+    # Читаем только нужные колонки и с известными типами.
+    wanted = set(REQUIRED_COLUMNS) | set(OPTIONAL_COLUMNS)
+    return pd.read_excel(
+        path,
+        header=1,
+        engine=_excel_engine(),
+        usecols=lambda c: c in wanted,
+        dtype=TEXT_DTYPES,
+    )
+
+
+def _text_col(s: pd.Series) -> pd.Series:
+    """Строковая колонка: strip, пустые/NaN → NA."""
+    return s.astype("string").str.strip()
 
-def _to_decimal(x) -> Decimal:
-    if x is None or (isinstance(x, float) and pd.isna(x)):
-        return Decimal("0")
-    return Decimal(str(x).replace(" ", "").replace(",", "."))
 
+def _money_col(s: pd.Series) -> pd.Series:
+    """Денежная колонка: "1 234,56" → 1234.56 одним проходом по всей колонке."""
+    # Excel обычно уже отдаёт числа — тогда без лишнего str → float круга.
+    # psycopg2 передаёт float через repr(), так что NUMERIC получает то же значение,
+    # что было в ячейке, без Decimal на каждую строку.
+    if pd.api.types.is_numeric_dtype(s):
+        return s.astype("float64")
 
-def _normalize_order_id(x) -> Optional[str]:
+    cleaned = (
+        s.astype("string")
+        .str.replace(" ", "", regex=False)
+        .str.replace(",", ".", regex=False)
+    )
+    return pd.to_numeric(cleaned, errors="coerce")
+
+
+def _prepare_rows(df: pd.DataFrame) -> pd.DataFrame:
     """
-    В отчёте:
-    - для строк заказа ID начисления часто = posting_number (36387264-0119-1)
-    - для расходов рекламы может быть число или пусто → тогда order_id = None
+    Векторно нормализуем отчёт в колонки INSERT_COLUMNS
+    (вместо iterrows, где на каждую строку строится pd.Series).
     """
-    if x is None or (isinstance(x, float) and pd.isna(x)):
-        return None
-    s = str(x).strip()
-    return s if POSTING_RE.match(s) else None
+    out = pd.DataFrame(index=df.index)
+
+    order_id = _text_col(df["ID начисления"])
+    # одна C-проходка regex по всей колонке (POSTING_RE уже скомпилирован)
+    out["order_id"] = order_id.where(order_id.str.match(POSTING_RE).fillna(False))
+
+    out["fee_group"] = _text_col(df["Группа услуг"])
+    fee_type = _text_col(df["Тип начисления"])
+    out["fee_name"] = fee_type          # fee_name = тип начисления (коротко и удобно)
+    out["amount"] = _money_col(df["Сумма итого, руб."]).fillna(0)
+
+    # percent в этом отчёте бывает в "Вознаграждение Ozon, %"
+    if "Вознаграждение Ozon, %" in df.columns:
+        out["percent"] = _money_col(df["Вознаграждение Ozon, %"])
+    else:
+        out["percent"] = None
+
+    # product_id у нас сейчас используется из posting.financial_data.
+    # В отчёте его нет — оставим NULL (позже можно добавить отдельную колонку sku и анализировать по SKU).
+    out["product_id"] = None
+    # битые/пустые SKU → NA одним проходом, без try/except на строку
+    sku = pd.to_numeric(df["SKU"], errors="coerce")
+    out["sku"] = sku.where(sku % 1 == 0).astype("Int64")  # дробные — тоже мусор
+    out["occurred_at"] = pd.to_datetime(
+        df["Дата принятия заказа в обработку или оказания услуги"], errors="coerce"
+    )
+    out["operation_type"] = fee_type    # operation_type = тот же тип начисления
+    out["source"] = SOURCE
+
+    # NaN/NA → None, чтобы psycopg2 записал NULL
+    out = out[INSERT_COLUMNS].astype(object)
+    return out.where(out.notna(), None)
+
+
+def _bulk_insert(cur, frame: pd.DataFrame) -> None:
+    """
+    Основной путь — COPY FROM STDIN (CSV из pandas одним вызовом, без SQL-парсинга на строку).
+    Если COPY недоступен (права/прокси) — откатываемся к savepoint и льём execute_values.
+    """
+    buf = io.StringIO()
+    frame.to_csv(buf, index=False, header=False, na_rep="\\N")
+    buf.seek(0)
+
+    cur.execute("SAVEPOINT finance_report_copy;")
+    try:
+        cur.copy_expert(COPY_SQL, buf)
+    except psycopg2.Error as e:
+        print(f"[finance_report_loader] COPY не удался ({e}), пишем через execute_values")
+        cur.execute("ROLLBACK TO SAVEPOINT finance_report_copy;")
+        execute_values(
+            cur,
+            f"INSERT INTO order_fee_items ({', '.join(INSERT_COLUMNS)}) VALUES %s;",
+            list(frame.itertuples(index=False, name=None)),
+            page_size=1000,
+        )
+    cur.execute("RELEASE SAVEPOINT finance_report_copy;")
 
 
 def load_accruals_report_xlsx(path: str):
-    # В отчёте первая строка = "Период: ....", заголовки начинаются со 2-й строки
-    df = pd.read_excel(path, header=1)
-
-    required = [
-        "ID начисления",
-        "Дата начисления",
-        "Группа услуг",
-        "Тип начисления",
-        "SKU",
-        "Дата принятия заказа в обработку или оказания услуги",
-        "Сумма итого, руб.",
-    ]
-    missing = [c for c in required if c not in df.columns]
+    df = _read_report(path)
+
+    missing = [c for c in REQUIRED_COLUMNS if c not in df.columns]
     if missing:
         raise RuntimeError(f"В отчёте не найдены колонки: {missing}")
 
+    frame = _prepare_rows(df)
+
     # Важно: чтобы ETL был идемпотентный — удалим строки этого источника за тот же период файла.
     # (Можно позже улучшить до удаления только по конкретным order_id.)
-    execute_query("DELETE FROM order_fee_items WHERE source = 'finance_report';")
-
-    insert_q = """
-    INSERT INTO order_fee_items (
-      order_id, fee_group, fee_name, amount,
-      percent, product_id, source, sku, occurred_at, operation_type
-    )
-    VALUES (%s,%s,%s,%s,%s,%s,'finance_report',%s,%s,%s);
-    """
-
-    for _, row in df.iterrows():
-        order_id = _normalize_order_id(row["ID начисления"])
-        fee_group = str(row["Группа услуг"]).strip() if pd.notna(row["Группа услуг"]) else None
-        fee_type = str(row["Тип начисления"]).strip() if pd.notna(row["Тип начисления"]) else None
-        amount = _to_decimal(row["Сумма итого, руб."])
-
-        sku = None
-        if pd.notna(row["SKU"]):
-            try:
-                sku = int(row["SKU"])
-            except Exception:
-                sku = None
-
-        occurred_at = row["Дата принятия заказа в обработку или оказания услуги"]
-        accrual_date = row["Дата начисления"]
-
-        # percent в этом отчёте бывает в "Вознаграждение Ozon, %"
-        percent = None
-        if "Вознаграждение Ozon, %" in df.columns and pd.notna(row.get("Вознаграждение Ozon, %")):
-            percent = _to_decimal(row["Вознаграждение Ozon, %"])
-
-        # product_id у нас сейчас используется из posting.financial_data.
-        # В отчёте его нет — оставим NULL (позже можно добавить отдельную колонку sku и анализировать по SKU).
-        product_id = None
-
-        execute_query(insert_q, (
-            order_id,
-            fee_group,
-            fee_type,      # fee_name = тип начисления (коротко и удобно)
-            amount,
-            percent,
-            product_id,
-            sku,
-            occurred_at if pd.notna(occurred_at) else None,
-            fee_type,      # operation_type = тот же тип начисления
-        ))
+    # DELETE + загрузка — в одной транзакции.
+    with get_cursor(commit=True) as cur:
+        cur.execute("DELETE FROM order_fee_items WHERE source = %s;", (SOURCE,))
+        _bulk_insert(cur, frame)
 
     # После загрузки отчёта пересчитываем totals в orders
     recalc_orders_finance()
@@ -4,11 +4,9 @@ from datetime import datetime, timedelta
 
 from .config import settings
 from .db import fetch_one
-from .ozon_seller_api import get_default_seller_client
-from .etl import load_fbo_orders_last_n_days
 
-from .metrics import get_summary, get_retention_distribution, get_cohort_by_first_order_month
-from datetime import datetime, timedelta
+# Тяжёлые модули (metrics/etl/клиент Ozon тянут pandas, requests и т.д.)
+# импортируем внутри функций, чтобы test_db() стартовал быстро.
 
 def test_db():
     print("DB host:", settings.DB_HOST)
@@ -20,6 +18,8 @@ def test_db():
 
 
 def test_ozon_seller_fbo():
+    from .ozon_seller_api import get_default_seller_client
+
     client = get_default_seller_client()
 
     date_to = datetime.utcnow()
@@ -40,6 +40,9 @@ def test_ozon_seller_fbo():
 
 
 def main():
+    from .etl import load_fbo_orders_last_n_days
+    from .metrics import get_summary
+
     print("=== Тест подключения к БД ===")
     test_db()
 
@@ -69,6 +72,8 @@ def test_metrics():
     Простой тестовый вывод метрик в консоль.
     Сейчас считаем по всем данным без фильтров.
     """
+    from .metrics import get_summary, get_retention_distribution, get_cohort_by_first_order_month
+
     print("\n=== Метрики по всем заказам ===")
     summary = get_summary()
     for k, v in summary.items():
@@ -20,20 +20,50 @@
 - flavor                — вкус корма (products.flavor)
 - grams                 — граммовка (products.grams)
 
-Для фильтров flavor/grams мы делаем JOIN:
-    orders -> order_items -> products
-и аккуратно защищаемся от дублей заказов через DISTINCT / подзапросы.
+Для фильтров flavor/grams мы проверяем товары через EXISTS:
+    orders -> EXISTS(order_items JOIN products)
+поэтому строки заказов не размножаются и DISTINCT не нужен.
 """
 
+import hashlib
+import time
 from datetime import datetime
+from functools import lru_cache
 from typing import Optional, Dict, Any, List, Tuple
 
-from .db import fetch_one, fetch_all
+import psycopg2.extras
+
+from .db import fetch_prepared
+
+
+# Дашборд часто перезапрашивает одни и те же фильтры в течение нескольких секунд.
+# Кэшируем саммари в памяти процесса на короткое время.
+SUMMARY_CACHE_TTL_SEC = 30
+SUMMARY_CACHE_MAXSIZE = 256
+
+# (поколение, ключ фильтров) -> (expires_at, summary)
+_summary_cache: Dict[tuple, Tuple[float, Dict[str, Any]]] = {}
+
+# Поколение данных: входит в ключ кэша, после ETL его увеличивает invalidate_metrics_cache.
+_cache_generation = 0
+
+
+def invalidate_metrics_cache() -> None:
+    """
+    Вызывать по завершении ETL в этом же процессе: новое поколение —
+    старые записи кэша больше не совпадают по ключу (даже если их допишет
+    запрос, начатый до сброса). В других процессах данные устареют
+    максимум на SUMMARY_CACHE_TTL_SEC.
+    """
+    global _cache_generation
+    _cache_generation += 1
+    _summary_cache.clear()
 
 
 # ---------- ВСПОМОГАТЕЛЬНЫЙ КОНСТРУКТОР ФИЛЬТРОВ ----------
 
 
+@lru_cache(maxsize=512)
 def build_orders_filter(
     date_from: Optional[datetime] = None,
     date_to: Optional[datetime] = None,
@@ -41,7 +71,7 @@ def build_orders_filter(
     first_order_only: Optional[bool] = None,
     flavor: Optional[str] = None,
     grams: Optional[int] = None,
-) -> Tuple[str, tuple, bool]:
+) -> Tuple[str, tuple]:
     """
     Сформировать WHERE-условие и параметры для фильтрации по таблице orders.
 
@@ -56,14 +86,20 @@ def build_orders_filter(
     - flavor: фильтр по products.flavor
     - grams:  фильтр по products.grams
 
+    Фильтры по товарам собираются в один EXISTS-подзапрос
+    (заказ подходит, если в нём есть товар с нужным вкусом И граммовкой).
+    В отличие от JOIN'а это не размножает строки orders, и Postgres может
+    ответить по индексам order_items(order_id, sku) / products(sku) INCLUDE (...).
+
     Возвращает:
     - where_sql: строка вида "WHERE ...", либо "" если фильтров нет
     - params:    кортеж параметров для подстановки в запрос
-    - needs_product_join: True, если нужны JOIN'ы к order_items/products
+
+    Результат неизменяемый, поэтому функция закэширована (lru_cache):
+    все аргументы хэшируемые (datetime/str/bool/int).
     """
     conditions: List[str] = []
     params: List[Any] = []
-    needs_product_join = False
 
     if date_from is not None:
         conditions.append("o.order_date >= %s")
@@ -83,42 +119,99 @@ def build_orders_filter(
         conditions.append("o.is_first_order = FALSE")
 
     # --- фильтры по товарам ---
+    product_conditions: List[str] = []
+
     if flavor is not None:
-        conditions.append("p.flavor = %s")
+        product_conditions.append("p.flavor = %s")
         params.append(flavor)
-        needs_product_join = True
 
     if grams is not None:
-        conditions.append("p.grams = %s")
+        product_conditions.append("p.grams = %s")
         params.append(grams)
-        needs_product_join = True
+
+    if product_conditions:
+        product_sql = " AND ".join(product_conditions)
+        conditions.append(
+            f"""EXISTS (
+            SELECT 1
+            FROM order_items oi
+            JOIN products p ON p.sku = oi.sku
+            WHERE oi.order_id = o.order_id
+              AND {product_sql}
+        )"""
+        )
 
     if conditions:
         where_sql = "WHERE " + " AND ".join(conditions)
     else:
         where_sql = ""
 
-    return where_sql, tuple(params), needs_product_join
+    return where_sql, tuple(params)
 
 
-def build_join_sql(needs_product_join: bool) -> str:
+def _stmt_name(query: str) -> str:
+    """Стабильное имя PREPARE-выражения по тексту запроса (форма фильтра → своё выражение)."""
+    return "metrics_" + hashlib.md5(query.encode("utf-8")).hexdigest()[:16]
+
+
+# ---------- БАЗОВЫЕ МЕТРИКИ ----------
+
+
+def _fetch_summary(
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    campaign: Optional[str] = None,
+    first_order_only: Optional[bool] = None,
+    flavor: Optional[str] = None,
+    grams: Optional[int] = None,
+) -> Dict[str, Any]:
     """
-    Вернуть кусок SQL с JOIN'ами, если нужны фильтры по товарам.
+    Все базовые метрики одним запросом (один скан orders вместо пяти).
 
-    Если flavor/grams не используются — JOIN не нужен.
+    Логика:
+    - filtered_orders — заказы под фильтры,
+    - customer_totals — выручка по каждому клиенту,
+    - дальше считаем всё по этим двум наборам.
     """
-    if not needs_product_join:
-        return ""
-
-    # INNER JOIN, т.к. если мы фильтруем по товару,
-    # нас интересуют только заказы, в которых он есть.
-    return """
-    JOIN order_items oi ON oi.order_id = o.order_id
-    JOIN products p ON p.sku = oi.sku
+    where_sql, params = build_orders_filter(
+        date_from, date_to, campaign, first_order_only, flavor, grams
+    )
+
+    query = f"""
+    WITH filtered_orders AS (
+        SELECT o.order_id, o.customer_id, o.revenue
+        FROM orders o
+        {where_sql}
+    ),
+    customer_totals AS (
+        SELECT
+            customer_id,
+            SUM(revenue) AS total_revenue
+        FROM filtered_orders
+        GROUP BY customer_id
+    )
+    SELECT
+        COUNT(*)                    AS total_orders,
+        COUNT(DISTINCT customer_id) AS total_customers,
+        SUM(revenue)                AS total_revenue,
+        AVG(revenue)                AS avg_order_value,
+        (SELECT AVG(total_revenue) FROM customer_totals) AS avg_revenue_per_customer
+    FROM filtered_orders;
     """
 
+    rows = fetch_prepared(_stmt_name(query), query, params)
+    row = rows[0] if rows else None
 
-# ---------- БАЗОВЫЕ МЕТРИКИ ----------
+    def _num(key: str) -> float:
+        return float(row[key]) if row and row[key] is not None else 0.0
+
+    return {
+        "total_orders": int(_num("total_orders")),
+        "total_customers": int(_num("total_customers")),
+        "total_revenue": _num("total_revenue"),
+        "avg_order_value": _num("avg_order_value"),
+        "avg_revenue_per_customer": _num("avg_revenue_per_customer"),
+    }
 
 
 def get_total_orders(
@@ -131,22 +224,10 @@ def get_total_orders(
 ) -> int:
     """
     Общее число заказов с учётом фильтров.
-    При наличии JOIN по товарам считаем DISTINCT по order_id.
     """
-    where_sql, params, needs_join = build_orders_filter(
+    return _fetch_summary(
         date_from, date_to, campaign, first_order_only, flavor, grams
-    )
-    join_sql = build_join_sql(needs_join)
-
-    query = f"""
-    SELECT COUNT(DISTINCT o.order_id) AS cnt
-    FROM orders o
-    {join_sql}
-    {where_sql};
-    """
-
-    row = fetch_one(query, params)
-    return int(row["cnt"]) if row and row["cnt"] is not None else 0
+    )["total_orders"]
 
 
 def get_total_customers(
@@ -161,20 +242,9 @@ def get_total_customers(
     Число уникальных клиентов (customer_id) среди заказов,
     подходящих под фильтры.
     """
-    where_sql, params, needs_join = build_orders_filter(
+    return _fetch_summary(
         date_from, date_to, campaign, first_order_only, flavor, grams
-    )
-    join_sql = build_join_sql(needs_join)
-
-    query = f"""
-    SELECT COUNT(DISTINCT o.customer_id) AS cnt
-    FROM orders o
-    {join_sql}
-    {where_sql};
-    """
-
-    row = fetch_one(query, params)
-    return int(row["cnt"]) if row and row["cnt"] is not None else 0
+    )["total_customers"]
 
 
 def get_total_revenue(
@@ -187,37 +257,10 @@ def get_total_revenue(
 ) -> float:
     """
     Общая выручка по заказам, подходящим под фильтры.
-
-    При фильтре по товарам делаем подзапрос с DISTINCT order_id,
-    чтобы не задвоить выручку при JOIN'ах.
     """
-    where_sql, params, needs_join = build_orders_filter(
+    return _fetch_summary(
         date_from, date_to, campaign, first_order_only, flavor, grams
-    )
-    join_sql = build_join_sql(needs_join)
-
-    if not needs_join:
-        query = f"""
-        SELECT SUM(o.revenue) AS total_revenue
-        FROM orders o
-        {where_sql};
-        """
-    else:
-        # сначала выбираем уникальные заказы и их выручку, потом суммируем
-        query = f"""
-        WITH filtered_orders AS (
-            SELECT DISTINCT o.order_id, o.revenue
-            FROM orders o
-            {join_sql}
-            {where_sql}
-        )
-        SELECT SUM(revenue) AS total_revenue
-        FROM filtered_orders;
-        """
-
-    row = fetch_one(query, params)
-    value = row["total_revenue"] if row and row["total_revenue"] is not None else 0
-    return float(value)
+    )["total_revenue"]
 
 
 def get_avg_order_value(
@@ -230,35 +273,10 @@ def get_avg_order_value(
 ) -> float:
     """
     Средний чек: средняя сумма заказа среди выбранных заказов.
-
-    При наличии JOIN'ов берём DISTINCT orders, затем считаем AVG по ним.
     """
-    where_sql, params, needs_join = build_orders_filter(
+    return _fetch_summary(
         date_from, date_to, campaign, first_order_only, flavor, grams
-    )
-    join_sql = build_join_sql(needs_join)
-
-    if not needs_join:
-        query = f"""
-        SELECT AVG(o.revenue) AS avg_order_value
-        FROM orders o
-        {where_sql};
-        """
-    else:
-        query = f"""
-        WITH filtered_orders AS (
-            SELECT DISTINCT o.order_id, o.revenue
-            FROM orders o
-            {join_sql}
-            {where_sql}
-        )
-        SELECT AVG(revenue) AS avg_order_value
-        FROM filtered_orders;
-        """
-
-    row = fetch_one(query, params)
-    value = row["avg_order_value"] if row and row["avg_order_value"] is not None else 0
-    return float(value)
+    )["avg_order_value"]
 
 
 def get_avg_revenue_per_customer(
@@ -271,57 +289,10 @@ def get_avg_revenue_per_customer(
 ) -> float:
     """
     Средняя выручка на клиента (LTV в рамках выбранного фильтра).
-
-    Логика:
-    - для каждого клиента считаем суммарную выручку по его заказам (с учётом фильтров),
-    - берём среднее по этим клиентам.
     """
-    where_sql, params, needs_join = build_orders_filter(
+    return _fetch_summary(
         date_from, date_to, campaign, first_order_only, flavor, grams
-    )
-    join_sql = build_join_sql(needs_join)
-
-    if not needs_join:
-        query = f"""
-        WITH customer_totals AS (
-            SELECT
-                o.customer_id,
-                SUM(o.revenue) AS total_revenue
-            FROM orders o
-            {where_sql}
-            GROUP BY o.customer_id
-        )
-        SELECT AVG(total_revenue) AS avg_revenue_per_customer
-        FROM customer_totals;
-        """
-    else:
-        # При JOIN'ах сначала выделяем уникальные заказы,
-        # затем агрегируем по клиентам.
-        query = f"""
-        WITH filtered_orders AS (
-            SELECT DISTINCT o.order_id, o.customer_id, o.revenue
-            FROM orders o
-            {join_sql}
-            {where_sql}
-        ),
-        customer_totals AS (
-            SELECT
-                customer_id,
-                SUM(revenue) AS total_revenue
-            FROM filtered_orders
-            GROUP BY customer_id
-        )
-        SELECT AVG(total_revenue) AS avg_revenue_per_customer
-        FROM customer_totals;
-        """
-
-    row = fetch_one(query, params)
-    value = (
-        row["avg_revenue_per_customer"]
-        if row and row["avg_revenue_per_customer"] is not None
-        else 0
-    )
-    return float(value)
+    )["avg_revenue_per_customer"]
 
 
 # ---------- RETENTION: РАСПРЕДЕЛЕНИЕ ПО КОЛИЧЕСТВУ ЗАКАЗОВ ----------
@@ -342,16 +313,14 @@ def get_retention_distribution(
     - считаем количество заказов на клиента,
     - группируем клиентов по этому числу.
     """
-    where_sql, params, needs_join = build_orders_filter(
+    where_sql, params = build_orders_filter(
         date_from, date_to, campaign, first_order_only=None, flavor=flavor, grams=grams
     )
-    join_sql = build_join_sql(needs_join)
 
     query = f"""
     WITH filtered_orders AS (
-        SELECT DISTINCT o.order_id, o.customer_id
+        SELECT o.order_id, o.customer_id
         FROM orders o
-        {join_sql}
         {where_sql}
     ),
     customer_orders AS (
@@ -362,21 +331,16 @@ def get_retention_distribution(
         GROUP BY customer_id
     )
     SELECT
-        orders_count,
-        COUNT(*) AS customers_count
+        orders_count::int AS orders_count,
+        COUNT(*)::int AS customers_count
     FROM customer_orders
     GROUP BY orders_count
     ORDER BY orders_count;
     """
 
-    rows = fetch_all(query, params)
-    return [
-        {
-            "orders_count": int(r["orders_count"]),
-            "customers_count": int(r["customers_count"]),
-        }
-        for r in rows
-    ]
+    return fetch_prepared(
+        _stmt_name(query), query, params, cursor_factory=psycopg2.extras.RealDictCursor
+    )
 
 
 # ---------- КОГОРТЫ ПО МЕСЯЦУ ПЕРВОГО ЗАКАЗА ----------
@@ -386,37 +350,24 @@ def get_cohort_by_first_order_month() -> List[Dict[str, Any]]:
     """
     Когортная таблица по месяцу первого заказа.
 
-    Источник — таблица customers (там already есть first_order_date, total_revenue).
+    Источник — материализованное представление customer_cohort_month
+    (агрегат по customers, обновляется в конце ETL).
 
     Без фильтров по продуктам — это "общая" когортная картинка.
     """
     query = """
     SELECT
-        DATE_TRUNC('month', first_order_date)::date AS cohort_month,
-        COUNT(*) AS customers_count,
-        SUM(total_revenue) AS cohort_revenue,
-        AVG(total_revenue) AS avg_revenue_per_customer
-    FROM customers
-    WHERE first_order_date IS NOT NULL
-    GROUP BY cohort_month
+        cohort_month,
+        customers_count::int AS customers_count,
+        COALESCE(cohort_revenue, 0)::float8 AS cohort_revenue,
+        COALESCE(avg_revenue_per_customer, 0)::float8 AS avg_revenue_per_customer
+    FROM customer_cohort_month
     ORDER BY cohort_month;
     """
 
-    rows = fetch_all(query)
-
-    result: List[Dict[str, Any]] = []
-    for r in rows:
-        result.append(
-            {
-                "cohort_month": r["cohort_month"],
-                "customers_count": int(r["customers_count"]),
-                "cohort_revenue": float(r["cohort_revenue"] or 0),
-                "avg_revenue_per_customer": float(
-                    r["avg_revenue_per_customer"] or 0
-                ),
-            }
-        )
-    return result
+    return fetch_prepared(
+        _stmt_name(query), query, cursor_factory=psycopg2.extras.RealDictCursor
+    )
 
 
 # ---------- ОБЩИЙ САММАРИ-БЛОК ДЛЯ ДАШБОРДА ----------
@@ -433,21 +384,24 @@ def get_summary(
     """
     Удобная функция: вернуть сразу набор ключевых метрик.
     Это удобно использовать в дашборде как "общий блок".
+
+    Считается одним запросом к БД (см. _fetch_summary)
+    и кэшируется на SUMMARY_CACHE_TTL_SEC секунд (или до invalidate_metrics_cache).
     """
-    return {
-        "total_orders": get_total_orders(
-            date_from, date_to, campaign, first_order_only, flavor, grams
-        ),
-        "total_customers": get_total_customers(
-            date_from, date_to, campaign, first_order_only, flavor, grams
-        ),
-        "total_revenue": get_total_revenue(
-            date_from, date_to, campaign, first_order_only, flavor, grams
-        ),
-        "avg_order_value": get_avg_order_value(
-            date_from, date_to, campaign, first_order_only, flavor, grams
-        ),
-        "avg_revenue_per_customer": get_avg_revenue_per_customer(
-            date_from, date_to, campaign, first_order_only, flavor, grams
-        ),
-    }
+    key = (_cache_generation, date_from, date_to, campaign, first_order_only, flavor, grams)
+    now = time.monotonic()
+
+    cached = _summary_cache.get(key)
+    if cached is not None and cached[0] > now:
+        return dict(cached[1])
+
+    summary = _fetch_summary(
+        date_from, date_to, campaign, first_order_only, flavor, grams
+    )
+
+    if len(_summary_cache) >= SUMMARY_CACHE_MAXSIZE:
+        # выкидываем самую старую запись (dict хранит порядок вставки)
+        _summary_cache.pop(next(iter(_summary_cache)))
+    _summary_cache[key] = (now + SUMMARY_CACHE_TTL_SEC, summary)
+
+    return dict(summary)
\ No newline at end of file
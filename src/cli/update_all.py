@@ -7,9 +7,12 @@
   python -m src.cli.update_all 2025-10-01 2025-12-12
 
 Идея:
-- всегда прогоняем миграции (идемпотентно)
+- всегда прогоняем миграции (идемпотентно); на пустой базе обычные индексы
+  строятся уже после первой загрузки
 - считаем диапазон дат (по умолчанию LOOKBACK)
 - выполняем шаги ETL по очереди
+  (с ETL_PARALLEL=1 независимые шаги finance/performance идут параллельно,
+  а finance-транзакции качаются в фоне ещё во время загрузки заказов)
 - добавляем понятные логи + тайминги
 - performance можно отключать флагами env, чтобы не валить весь ETL
 """
@@ -20,14 +23,16 @@ import os
 import sys
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 from typing import Callable, Optional, Tuple
 
-from src.migrations.run import run as run_migrations
+from src.core.config import settings
+from src.migrations.run import create_indexes, needs_bootstrap, run as run_migrations
 
-from src.etl.orders.load_orders import load_fbo_orders_for_period
-from src.etl.finance.finance_api import run as run_finance_api
+from src.etl.orders.load_orders import load_fbo_orders_for_period, refresh_customer_cohorts
+from src.etl.finance.finance_api import prefetch_transactions, run as run_finance_api
 from src.etl.finance.period_costs import recalc_period_costs as run_period_costs
 
 from src.etl.performance.campaigns import load_campaigns as run_perf_campaigns
@@ -46,14 +51,24 @@ ENABLE_PERF_ORDERS = os.getenv("ETL_ENABLE_PERF_ORDERS", "1") == "1"
 # Если 1 — падать на любом этапе; если 0 — продолжать (кроме orders/migrations)
 STRICT_MODE = os.getenv("ETL_STRICT_MODE", "1") == "1"
 
+# Если 1 — независимые шаги (finance + performance) выполняются параллельно в потоках.
+# Они упираются в HTTP к Ozon, так что потоки реально ускоряют (GIL отпускается на I/O).
+PARALLEL = os.getenv("ETL_PARALLEL", "0") == "1"
+PARALLEL_MAX_WORKERS = int(os.getenv("ETL_PARALLEL_WORKERS", "4"))
+
 # Удобно, когда запускаем в контейнере и хотим видеть время в логах
 LOG_TIME_UTC = os.getenv("ETL_LOG_TIME_UTC", "1") == "1"
 
 
+_LOG_TIME_FMT_UTC = "%Y-%m-%dT%H:%M:%SZ"
+_LOG_TIME_FMT_LOCAL = "%Y-%m-%dT%H:%M:%S"
+
+
 def _now_str() -> str:
+    # time.strftime по struct_time дешевле, чем создавать datetime на каждую строку лога
     if LOG_TIME_UTC:
-        return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-    return datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        return time.strftime(_LOG_TIME_FMT_UTC, time.gmtime())
+    return time.strftime(_LOG_TIME_FMT_LOCAL, time.localtime())
 
 
 def log(msg: str) -> None:
@@ -75,6 +90,7 @@ class Step:
     name: str
     fn: Callable[[], None]
     required: bool = False  # если True — ошибка валит весь ETL
+    parallel: bool = False  # можно запускать одновременно с соседними parallel-шагами
 
 
 def _run_step(step: Step) -> None:
@@ -97,7 +113,47 @@ def _run_step(step: Step) -> None:
             log(f"⚠️  continue after failure (STRICT_MODE=0): {step.name}")
 
 
+def _run_parallel(steps: list[Step]) -> None:
+    """
+    Запускает группу независимых шагов в пуле потоков.
+    Семантика STRICT_MODE/required та же, что у _run_step:
+    дожидаемся всех шагов группы и только потом пробрасываем первую ошибку.
+    """
+    log(f"⏩ parallel group: {', '.join(s.name for s in steps)}")
+    errors: list[BaseException] = []
+
+    with ThreadPoolExecutor(max_workers=min(PARALLEL_MAX_WORKERS, len(steps))) as ex:
+        futures = {ex.submit(_run_step, s): s for s in steps}
+        for f in as_completed(futures):
+            err = f.exception()
+            if err is not None:
+                errors.append(err)
+
+    if errors:
+        raise errors[0]
+
+
+def _run_steps(steps: list[Step]) -> None:
+    """
+    Выполняет шаги по порядку. При PARALLEL подряд идущие parallel-шаги
+    собираются в одну группу и выполняются одновременно.
+    """
+    batch: list[Step] = []
+    for s in steps:
+        if PARALLEL and s.parallel:
+            batch.append(s)
+            continue
+        if batch:
+            _run_parallel(batch)
+            batch = []
+        _run_step(s)
+
+    if batch:
+        _run_parallel(batch)
+
+
 def update_all(date_from: str | None = None, date_to: str | None = None) -> None:
+    settings.validate()
     date_from_s, date_to_s = _compute_range(date_from, date_to)
 
     log("========================================")
@@ -107,17 +163,32 @@ def update_all(date_from: str | None = None, date_to: str | None = None) -> None
         f"PERF_CAMPAIGNS={int(ENABLE_PERF_CAMPAIGNS)} "
         f"PERF_DAILY={int(ENABLE_PERF_DAILY)} "
         f"PERF_ORDERS={int(ENABLE_PERF_ORDERS)} "
-        f"STRICT_MODE={int(STRICT_MODE)}")
+        f"STRICT_MODE={int(STRICT_MODE)} "
+        f"PARALLEL={int(PARALLEL)}")
     log("========================================")
 
     # Заказы — удобнее передать datetime (как у тебя)
     date_from_dt = datetime.strptime(date_from_s, "%Y-%m-%d")
     date_to_dt = datetime.strptime(date_to_s, "%Y-%m-%d")
 
+    # Первый запуск на пустой базе: обычные индексы строим после загрузки,
+    # чтобы массовые вставки не обновляли их на каждой строке
+    bootstrap = needs_bootstrap()
+    if bootstrap:
+        log("bootstrap: empty database, non-unique indexes will be built after the load")
+
+    # Скачивание finance-транзакций не зависит от заказов (только HTTP к другому API):
+    # с ETL_PARALLEL=1 качаем их в фоне, пока идут миграции и загрузка заказов.
+    # Пишет в БД finance-шаг уже после orders — привязка к заказам не меняется.
+    prefetch_pool = ThreadPoolExecutor(max_workers=1) if PARALLEL else None
+    finance_prefetch = (
+        prefetch_pool.submit(prefetch_transactions, date_from_s, date_to_s) if prefetch_pool else None
+    )
+
     steps: list[Step] = [
         Step(
             name="migrations",
-            fn=lambda: run_migrations(),
+            fn=lambda: run_migrations(with_indexes=not bootstrap),
             required=True,
         ),
         Step(
@@ -127,13 +198,13 @@ def update_all(date_from: str | None = None, date_to: str | None = None) -> None
         ),
         Step(
             name="finance (seller finance api)",
-            fn=lambda: run_finance_api(date_from_s, date_to_s),
-            required=False,
-        ),
-        Step(
-            name="period_costs (recalc aggregates)",
-            fn=lambda: run_period_costs(date_from_s, date_to_s),
+            fn=lambda: run_finance_api(
+                date_from_s,
+                date_to_s,
+                prefetched=finance_prefetch.result() if finance_prefetch else None,
+            ),
             required=False,
+            parallel=True,
         ),
     ]
 
@@ -144,6 +215,7 @@ def update_all(date_from: str | None = None, date_to: str | None = None) -> None
                     name="performance campaigns (catalog)",
                     fn=lambda: run_perf_campaigns(),
                     required=False,
+                    parallel=True,
                 )
             )
         else:
@@ -155,6 +227,7 @@ def update_all(date_from: str | None = None, date_to: str | None = None) -> None
                     name="performance daily",
                     fn=lambda: run_perf_daily(date_from_s, date_to_s),
                     required=False,
+                    parallel=True,
                 )
             )
         else:
@@ -166,6 +239,7 @@ def update_all(date_from: str | None = None, date_to: str | None = None) -> None
                     name="performance orders attribution",
                     fn=lambda: run_perf_orders(date_from_s, date_to_s),
                     required=False,
+                    parallel=True,
                 )
             )
         else:
@@ -173,9 +247,40 @@ def update_all(date_from: str | None = None, date_to: str | None = None) -> None
     else:
         log("skip: performance (ETL_ENABLE_PERFORMANCE=0)")
 
+    # period_costs агрегирует строки finance_api — поэтому после группы finance/performance
+    steps.append(
+        Step(
+            name="period_costs (refresh view)",
+            fn=lambda: run_period_costs(),
+            required=False,
+        )
+    )
+
+    if bootstrap:
+        steps.append(
+            Step(
+                name="indexes (deferred, after first load)",
+                fn=lambda: create_indexes(),
+                required=True,
+            )
+        )
+
+    # материализованные представления для дашбордов — в самом конце, по готовым данным
+    steps.append(
+        Step(
+            name="customer cohorts (refresh view)",
+            fn=lambda: refresh_customer_cohorts(),
+            required=False,
+        )
+    )
+
     t0 = time.time()
-    for s in steps:
-        _run_step(s)
+    try:
+        _run_steps(steps)
+    finally:
+        if prefetch_pool:
+            # если упали раньше finance-шага — не ждём фоновую выкачку
+            prefetch_pool.shutdown(wait=False, cancel_futures=True)
 
     total = time.time() - t0
     log("========================================")
@@ -9,48 +9,77 @@
 """
 
 import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
 from dotenv import load_dotenv
 
 # Загружаем переменные из файла .env (если он есть в корне проекта)
 # Файл .env НЕ должен коммититься в репозиторий, там секреты.
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-ENV_PATH = os.path.join(BASE_DIR, ".env")
+BASE_DIR = Path(__file__).resolve().parent.parent
+ENV_PATH = BASE_DIR / ".env"
+
+# Переменные, которые читает Settings. Если все они уже заданы в окружении
+# (контейнер/CI), .env не нужен — не трогаем диск.
+_SETTINGS_ENV = (
+    "OZON_CLIENT_ID",
+    "OZON_API_KEY",
+    "OZON_PERF_CLIENT_ID",
+    "OZON_PERF_CLIENT_SECRET",
+    "DB_HOST",
+    "DB_PORT",
+    "DB_NAME",
+    "DB_USER",
+    "DB_PASSWORD",
+)
+
+
+def _load_env() -> bool:
+    """Читаем .env, только если в окружении задано не всё (в контейнере файл не нужен)."""
+    if all(os.getenv(name) for name in _SETTINGS_ENV):
+        return False
+    return load_dotenv(dotenv_path=ENV_PATH)
+
 
-load_dotenv(dotenv_path=ENV_PATH)
+_load_env()
 
 
+def _env(name: str, default: str = ""):
+    return field(default_factory=lambda: os.getenv(name, default))
+
+
+@dataclass(frozen=True, slots=True)
 class Settings:
     """
-    Класс-обёртка для настроек.
+    Неизменяемый объект настроек, значения читаются из окружения при создании.
     Это удобнее, чем каждый раз дергать os.getenv напрямую.
     """
 
     # Настройки Ozon Seller API
-    OZON_CLIENT_ID: str = os.getenv("OZON_CLIENT_ID", "")
-    OZON_API_KEY: str = os.getenv("OZON_API_KEY", "")
+    OZON_CLIENT_ID: str = _env("OZON_CLIENT_ID")
+    OZON_API_KEY: str = _env("OZON_API_KEY")
 
     # Настройки Ozon Performance API
-    OZON_PERF_CLIENT_ID: str = os.getenv("OZON_PERF_CLIENT_ID", "")
-    OZON_PERF_CLIENT_SECRET: str = os.getenv("OZON_PERF_CLIENT_SECRET", "")
+    OZON_PERF_CLIENT_ID: str = _env("OZON_PERF_CLIENT_ID")
+    OZON_PERF_CLIENT_SECRET: str = _env("OZON_PERF_CLIENT_SECRET")
 
     # Настройки БД PostgreSQL
-    DB_HOST: str = os.getenv("DB_HOST", "localhost")
-    DB_PORT: int = int(os.getenv("DB_PORT", "5432"))
-    DB_NAME: str = os.getenv("DB_NAME", "ozon_analytics")
-    DB_USER: str = os.getenv("DB_USER", "postgres")
-    DB_PASSWORD: str = os.getenv("DB_PASSWORD", "postgres")
-
-    @classmethod
-    def validate(cls):
+    DB_HOST: str = _env("DB_HOST", "localhost")
+    DB_PORT: int = field(default_factory=lambda: int(os.getenv("DB_PORT", "5432")))
+    DB_NAME: str = _env("DB_NAME", "ozon_analytics")
+    DB_USER: str = _env("DB_USER", "postgres")
+    DB_PASSWORD: str = _env("DB_PASSWORD", "postgres")
+
+    def validate(self) -> None:
         """
         Простая проверка, что самые важные переменные заданы.
-        Можно расширить по вкусу.
+        Вызывается явно из CLI (update_all), а не при импорте модуля.
         """
         missing = []
 
-        if not cls.OZON_CLIENT_ID:
+        if not self.OZON_CLIENT_ID:
             missing.append("OZON_CLIENT_ID")
-        if not cls.OZON_API_KEY:
+        if not self.OZON_API_KEY:
             missing.append("OZON_API_KEY")
 
         if missing:
@@ -64,4 +93,7 @@ class Settings:
 
 # Создаём единый объект настроек, который будем импортировать в других модулях.
 settings = Settings()
-settings.validate()
\ No newline at end of file
+
+
+if __name__ == "__main__":
+    settings.validate()
@@ -9,19 +9,34 @@
 - Спрятать детали psycopg2 в одном месте.
 """
 
+import atexit
+import csv
+import io
+import os
+import re
+import threading
+import weakref
+
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 from contextlib import contextmanager
 
 from .config import settings
 
-def get_connection():
-    """
-    Создаёт и возвращает новое соединение с PostgreSQL.
+# Размер пула соединений (ETL в параллельном режиме держит по соединению на поток)
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "8"))
+
+_pool: psycopg2.pool.ThreadedConnectionPool | None = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool при исчерпании бросает PoolError — семафором заставляем ждать
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
 
-    Важно:
-    - В реальном приложении можно использовать пул подключений (например, psycopg2.pool),
-      но для простого аналитического скрипта достаточно простого подключения.
+def _connect():
+    """
+    Создаёт новое соединение с PostgreSQL (без пула).
     """
     # ВРЕМЕННЫЙ дебаг: покажем, что реально у нас в настройках.
     # print("[db] Подключаемся к БД с параметрами:")
@@ -41,8 +56,72 @@ def get_connection():
     return conn
 
 
+def _get_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = psycopg2.pool.ThreadedConnectionPool(
+                    minconn=1,
+                    maxconn=DB_POOL_MAX,
+                    host=settings.DB_HOST,
+                    port=settings.DB_PORT,
+                    dbname=settings.DB_NAME,
+                    user=settings.DB_USER,
+                    password=settings.DB_PASSWORD,
+                )
+    return _pool
+
+
+def get_connection():
+    """
+    Берёт соединение из пула (создаётся лениво при первом обращении).
+
+    Соединение обязательно вернуть через release_connection()
+    (get_cursor/fetch_* делают это сами).
+    Если все DB_POOL_MAX соединений заняты — ждём, пока освободится.
+    """
+    _pool_slots.acquire()
+    try:
+        return _get_pool().getconn()
+    except Exception:
+        _pool_slots.release()
+        raise
+
+
+def release_connection(conn) -> None:
+    """
+    Возвращает соединение в пул.
+    Незакрытая транзакция откатывается, битое соединение выбрасывается из пула.
+    """
+    try:
+        broken = bool(conn.closed)
+        if not broken and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        _get_pool().putconn(conn, close=broken)
+    finally:
+        _pool_slots.release()
+
+
+def close_pool() -> None:
+    """
+    Закрывает все соединения пула (вызывается автоматически при выходе из процесса).
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+atexit.register(close_pool)
+
+
 @contextmanager
-def get_cursor(commit: bool = False):
+def get_cursor(commit: bool = False, cursor_factory=psycopg2.extras.DictCursor):
     """
     Контекстный менеджер для работы с курсором.
 
@@ -52,25 +131,51 @@ def get_cursor(commit: bool = False):
 
     Параметр commit:
     - Если True — по завершении блока будет вызван conn.commit()
-    - Если False — просто закроем курсор и соединение без commit()
+    - Если False — без commit(): транзакция откатится при возврате соединения в пул
+
+    Параметр cursor_factory:
+    - по умолчанию DictCursor: row["field_name"] и row[0]
+    - RealDictCursor: строки сразу обычные dict
     """
     conn = get_connection()
     # DictCursor позволяет получать строки в виде словаря: row["field_name"]
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur = conn.cursor(cursor_factory=cursor_factory)
 
     try:
         yield cur
         if commit:
             conn.commit()
     except Exception as e:
-        # При ошибке откатываем транзакцию
-        conn.rollback()
+        # При ошибке откатываем транзакцию (если соединение ещё живо)
+        if not conn.closed:
+            conn.rollback()
         print("[db] Ошибка при выполнении SQL:", e)
         raise
     finally:
-        # В любом случае закрываем ресурсы
+        # В любом случае закрываем курсор и возвращаем соединение в пул
         cur.close()
-        conn.close()
+        release_connection(conn)
+
+
+@contextmanager
+def transaction(synchronous_commit: bool = True):
+    """
+    Одна транзакция на весь блок: одно соединение из пула, один commit в конце
+    (при ошибке — rollback всего блока).
+
+    Пример:
+        with transaction() as cur:
+            cur.execute("INSERT ...")
+            cur.execute("UPDATE ...")
+
+    synchronous_commit=False — SET LOCAL synchronous_commit = off: commit не ждёт fsync WAL.
+    Только для данных, которые можно перезалить (из API), — при падении сервера
+    последняя транзакция может потеряться.
+    """
+    with get_cursor(commit=True) as cur:
+        if not synchronous_commit:
+            cur.execute("SET LOCAL synchronous_commit = off;")
+        yield cur
 
 
 def execute_query(query: str, params: tuple | None = None):
@@ -84,6 +189,42 @@ def execute_query(query: str, params: tuple | None = None):
         cur.execute(query, params)
 
 
+@contextmanager
+def autocommit_cursor():
+    """
+    Курсор на отдельном соединении вне пула, в autocommit — для команд, которые
+    в транзакции запрещены: CREATE/DROP INDEX CONCURRENTLY, VACUUM и т.п.
+    Такие команды идут минутами; своё соединение не занимает слот пула,
+    и ETL-потоки в это время продолжают работать. Соединение закрывается на выходе.
+    """
+    conn = _connect()
+    try:
+        conn.autocommit = True
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+            yield cur
+    finally:
+        conn.close()
+
+
+def copy_rows(cur, table: str, columns: list[str] | tuple[str, ...], rows) -> None:
+    """
+    Массовая вставка через COPY ... FROM STDIN (CSV) внутри транзакции курсора cur.
+
+    Быстрее execute_values на больших объёмах: один поток данных без SQL на строку.
+    None пишется как \\N (NULL), пустая строка остаётся пустой строкой.
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(["\\N" if v is None else v for v in row])
+    buf.seek(0)
+
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT CSV, NULL '\\N')",
+        buf,
+    )
+
+
 def fetch_all(query: str, params: tuple | None = None):
     """
     Выполнить SELECT и вернуть все строки.
@@ -97,6 +238,70 @@ def fetch_all(query: str, params: tuple | None = None):
     return rows
 
 
+# Имена PREPARE-выражений, уже созданных на конкретном соединении
+# (prepared statement живёт, пока живёт сессия Postgres).
+_prepared_statements: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+_PLACEHOLDER_RE = re.compile(r"%([s%])")
+
+
+def _to_positional(query: str) -> str:
+    """%s → $1, $2, ... (и %% → %), как требует PREPARE."""
+    n = 0
+
+    def repl(m: re.Match) -> str:
+        nonlocal n
+        if m.group(1) == "%":
+            return "%"
+        n += 1
+        return f"${n}"
+
+    return _PLACEHOLDER_RE.sub(repl, query)
+
+
+def _execute_prepared(cur, name: str, query: str, params: tuple) -> None:
+    """
+    PREPARE (один раз на соединение) + EXECUTE на курсоре cur.
+    Имена — в нижнем регистре (так их хранит pg_prepared_statements).
+    """
+    names = _prepared_statements.setdefault(cur.connection, set())
+    try:
+        if name not in names:
+            # после ошибки мы "забываем" имя, а в сессии оно может остаться — проверяем
+            cur.execute("SELECT 1 FROM pg_prepared_statements WHERE name = %s;", (name,))
+            if cur.fetchone() is None:
+                cur.execute(f"PREPARE {name} AS {_to_positional(query)}")
+            names.add(name)
+
+        if params:
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+        else:
+            cur.execute(f"EXECUTE {name}")
+    except Exception:
+        # после ошибки состояние сессии неизвестно — при следующем вызове проверим заново
+        names.discard(name)
+        raise
+
+
+def fetch_prepared(
+    name: str,
+    query: str,
+    params: tuple | None = None,
+    cursor_factory=psycopg2.extras.DictCursor,
+):
+    """
+    SELECT через серверный PREPARE/EXECUTE: Postgres разбирает и планирует запрос
+    один раз на соединение, дальше только EXECUTE с новыми параметрами.
+
+    name  - имя выражения (одинаковый текст запроса → одинаковое имя)
+    query - SQL с плейсхолдерами %s (как в fetch_all)
+    """
+    with get_cursor(commit=False, cursor_factory=cursor_factory) as cur:
+        _execute_prepared(cur, name, query, params or ())
+        rows = cur.fetchall()
+    return rows
+
+
 def fetch_one(query: str, params: tuple | None = None):
     """
     Выполнить SELECT и вернуть одну строку (или None, если пусто).
@@ -0,0 +1,48 @@
+# src/core/http.py
+
+"""
+Общая HTTP-сессия для клиентов Ozon (Seller, Performance, отчёты)
+и быстрый разбор JSON-ответов (json_loads: orjson, если установлен).
+
+Одна requests.Session на процесс: keep-alive и пул соединений по хосту,
+без нового TCP+TLS handshake на каждый запрос.
+
+Ретраи адаптера — только на 429/5xx и только для идемпотентных методов
+(GET и т.п., дефолт urllib3): POST-запросы модули ретраят сами, если им это нужно.
+Заголовки авторизации в сессию не кладём — их передаём в каждом запросе,
+потому что сессию делят разные API и потоки.
+"""
+
+from typing import Any
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # orjson разбирает большие ответы (postings, отчёты, транзакции) в разы быстрее stdlib json
+    import orjson
+
+    def json_loads(raw: bytes) -> Any:
+        return orjson.loads(raw)
+except ImportError:
+    import json
+
+    def json_loads(raw: bytes) -> Any:
+        return json.loads(raw)
+
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            # итоговый статус отдаём наверх, там raise_for_status / своё сообщение
+            raise_on_status=False,
+        ),
+    ),
+)
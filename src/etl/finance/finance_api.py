@@ -11,16 +11,21 @@ ETL "прочих трат" из Ozon Seller API:
 
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from decimal import Decimal
-from typing import Any, Dict, List, Optional
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Optional
 import requests
-import time
-import random
 import hashlib
+import re
+
+from psycopg2.extras import execute_values
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from src.core.config import settings
-from src.core.db import execute_query, fetch_one
+from src.core.db import fetch_all, transaction
+from src.core.http import json_loads
 
 from src.etl.orders.load_orders import recalc_orders_finance\
 
@@ -46,15 +51,66 @@ def make_fee_uid(
     ])
     return hashlib.md5(s.encode("utf-8")).hexdigest()
 
-def order_exists(order_id: str) -> bool:
-    return fetch_one("SELECT 1 FROM orders WHERE order_id=%s LIMIT 1;", (order_id,)) is not None
+def _op_order_candidate(op: dict) -> str | None:
+    # ✅ правильная привязка к заказу
+    posting = op.get("posting") or {}
+    posting_number = (
+        posting.get("posting_number")
+        or op.get("posting_number")
+        or op.get("order_id")
+        or None
+    )
+    return str(posting_number).strip() if posting_number else None
+
+def preload_order_ids(candidates) -> tuple[set[str], dict[str, str]]:
+    """
+    Один запрос на страницу транзакций вместо 1–2 SELECT на каждую операцию.
+    Возвращает (exact, by_prefix):
+    - exact — кандидаты, которые есть в orders как order_id;
+    - by_prefix — {cand: самый свежий order_id вида "<cand>-*"} для остальных.
+    """
+    cands = sorted({str(c).strip() for c in candidates if c})
+    if not cands:
+        return set(), {}
+
+    rows = fetch_all(
+        """
+        SELECT c.cand, e.order_id IS NOT NULL AS is_exact, p.order_id AS prefix_order_id
+        FROM unnest(%s::text[]) AS c(cand)
+        LEFT JOIN orders e ON e.order_id = c.cand
+        LEFT JOIN LATERAL (
+            SELECT o.order_id
+            FROM orders o
+            WHERE e.order_id IS NULL
+              -- префикс явным диапазоном ('.' следует за '-'), чтобы шёл
+              -- idx_orders_order_id_prefix: LIKE с шаблоном из соседней
+              -- таблицы планировщик в индексное условие не превращает
+              AND o.order_id ~>=~ (c.cand || '-')
+              AND o.order_id ~<~ (c.cand || '.')
+              AND o.order_id LIKE c.cand || '-%%'
+            ORDER BY o.order_date DESC
+            LIMIT 1
+        ) p ON true;
+        """,
+        (cands,),
+    )
+
+    exact = {r["cand"] for r in rows if r["is_exact"]}
+    by_prefix = {r["cand"]: r["prefix_order_id"] for r in rows if r["prefix_order_id"]}
+    return exact, by_prefix
 
-def resolve_order_id(order_id_candidate: str | None) -> tuple[str | None, str | None]:
+def resolve_order_id(
+    order_id_candidate: str | None,
+    exact: set[str],
+    by_prefix: dict[str, str],
+) -> tuple[str | None, str | None]:
     """
     Возвращает (order_id_to_save, ext_order_id)
     - если нашли точное совпадение — пишем в order_id
-    - если не нашли, но нашли 1 заказ по шаблону <candidate>-* — привязываем
+    - если не нашли, но нашли заказ по шаблону <candidate>-* — привязываем
+      (если матчей несколько — берём самый свежий)
     - иначе оставляем order_id NULL и пишем в ext_order_id
+    exact / by_prefix — результат preload_order_ids по этой странице.
     """
     if not order_id_candidate:
         return None, None
@@ -62,86 +118,99 @@ def resolve_order_id(order_id_candidate: str | None) -> tuple[str | None, str |
     cand = str(order_id_candidate).strip()
 
     # 1) точное совпадение
-    if order_exists(cand):
+    if cand in exact:
         return cand, None
 
-    # 2) попытка найти order_id вида "<cand>-X"
-    row = fetch_one(
-        "SELECT order_id FROM orders WHERE order_id LIKE %s ORDER BY order_date DESC LIMIT 2;",
-        (cand + "-%",)
-    )
-    if row and row.get("order_id"):
-        # если матчей несколько — мы взяли самый свежий. Можно улучшить позже.
-        return row["order_id"], cand
+    # 2) order_id вида "<cand>-X"
+    if cand in by_prefix:
+        return by_prefix[cand], cand
 
     return None, cand
 
 BASE_URL = "https://api-seller.ozon.ru"
 
 
-def _dec(x: Any) -> Decimal:
+def _amount(x: Any) -> Any:
+    """
+    Сумма для NUMERIC-колонки без Decimal на каждую строку: числа из JSON
+    psycopg2 передаёт как есть (float — через repr, без потери знаков),
+    строки вида "1 234,56" только чистим — NUMERIC из них соберёт Postgres.
+    """
     if x is None:
-        return Decimal("0")
-    return Decimal(str(x).replace(" ", "").replace(",", "."))
+        return 0
+    if isinstance(x, str):
+        return x.replace(" ", "").replace(",", ".")
+    return x
+
+# Одна сессия на процесс: keep-alive к api-seller.ozon.ru вместо TLS-handshake
+# на каждую страницу. Временные ошибки сервера ретраит сам адаптер
+# (экспоненциальная пауза); raise_on_status=False — после последней попытки
+# получаем обычный ответ и падаем с текстом ошибки Ozon, как раньше.
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=4,
+        max_retries=Retry(
+            total=6,
+            backoff_factor=1.5,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=frozenset(["POST"]),
+            raise_on_status=False,
+        ),
+    ),
+)
+
+# Заголовки не меняются между запросами — кладём их в сессию один раз
+_SESSION.headers.update({
+    "Client-Id": settings.OZON_CLIENT_ID,
+    "Api-Key": settings.OZON_API_KEY,
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+})
 
 def _post(path: str, payload: dict) -> dict:
-    url = f"{BASE_URL}{path}"
-    headers = {
-        "Client-Id": settings.OZON_CLIENT_ID,
-        "Api-Key": settings.OZON_API_KEY,
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }
-
-    # ретраи только для 500/502/503/504
-    max_retries = 6
-    base_sleep = 1.5
-
-    for attempt in range(max_retries):
-        r = requests.post(url, json=payload, headers=headers, timeout=90)
-
-        if r.ok:
-            return r.json()
-
-        # если это временная ошибка сервера — пробуем ещё раз
-        if r.status_code in (500, 502, 503, 504):
-            sleep = base_sleep * (2 ** attempt) + random.uniform(0, 0.5)
-            print(f"[finance] Ozon {r.status_code} on {path}, retry in {sleep:.1f}s...")
-            time.sleep(sleep)
-            continue
-
-        # всё остальное — фатально
+    r = _SESSION.post(BASE_URL + path, json=payload, timeout=90)
+    if not r.ok:
         raise RuntimeError(f"Ozon API error {r.status_code}: {r.text}")
-
-    # если исчерпали ретраи
-    raise RuntimeError(f"Ozon API error: too many retries, last={r.status_code}: {r.text}")
+    return json_loads(r.content)
 
 def _iso(dt: datetime) -> str:
     # Ozon обычно принимает ISO8601 с Z
     return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
+# Правила в порядке приоритета: первая сработавшая группа побеждает.
+# Различных названий услуг — десятки на всё окно, поэтому _guess_fee_group
+# и normalize_fee_name ещё и кэшируются (lru_cache).
+# Ключевые слова каждой группы — одна скомпилированная regex-альтернатива:
+# один проход по строке в C вместо цепочки `in` в Python.
+_FEE_GROUP_RULES = tuple(
+    (re.compile("|".join(map(re.escape, keywords))), group)
+    for keywords, group in (
+        # Комиссия
+        (("вознаграж", "комисс", "commission"), "Вознаграждение Ozon"),
+        # Логистика / продвижение
+        (("logistic", "логист", "достав", "last mile", "courier"), "Услуги доставки"),
+        # Эквайринг
+        (("эквайр", "acquiring"), "Услуги агентов"),
+        # Реклама / продвижение
+        (("клик", "cpc", "cpo", "реклам", "продвиж"), "Продвижение и реклама"),
+    )
+)
+
+@lru_cache(maxsize=4096)
 def _guess_fee_group(service_name: str) -> str:
     s = (service_name or "").lower()
 
-    # Комиссия
-    if "вознаграж" in s or "комисс" in s or "commission" in s:
-        return "Вознаграждение Ozon"
-
-    # Логистика / продвижение
-    if "logistic" in s or "логист" in s or "достав" in s or "last mile" in s or "courier" in s:
-        return "Услуги доставки"
+    for pattern, group in _FEE_GROUP_RULES:
+        if pattern.search(s):
+            return group
 
-    # Эквайринг
-    if "эквайр" in s or "acquiring" in s:
-        return "Услуги агентов"
-
-    # Реклама / продвижение
-    if "клик" in s or "cpc" in s or "cpo" in s or "реклам" in s or "продвиж" in s:
-        return "Продвижение и реклама"
-    
     return "Прочее"
 
+@lru_cache(maxsize=4096)
 def normalize_fee_name(name: str) -> str:
     if not name:
         return "UNKNOWN"
@@ -172,12 +241,7 @@ def fetch_transactions(date_from: datetime, date_to: datetime, page: int, page_s
     return _post("/v3/finance/transaction/list", payload)
 
 
-def load_transactions_window(date_from: datetime, date_to: datetime):
-    """
-    Загружает транзакции за окно [date_from; date_to] и кладёт в order_fee_items.
-    """
-
-    insert_q = """
+FEE_UPSERT_SQL = """
         INSERT INTO order_fee_items (
         uid,
         order_id, ext_order_id,
@@ -186,7 +250,7 @@ def load_transactions_window(date_from: datetime, date_to: datetime):
         occurred_at, sku,
         source
         )
-        VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,'finance_api')
+        VALUES %s
         ON CONFLICT (uid) DO UPDATE
         SET
         order_id = EXCLUDED.order_id,
@@ -198,154 +262,207 @@ def load_transactions_window(date_from: datetime, date_to: datetime):
         occurred_at = EXCLUDED.occurred_at,
         sku = EXCLUDED.sku;
         """
+FEE_UPSERT_TEMPLATE = "(%s,%s,%s,%s,%s,%s,%s,%s,%s,'finance_api')"
+
+# размер страницы /v3/finance/transaction/list и сколько страниц качаем одновременно
+TRANSACTIONS_PAGE_SIZE = 200
+PAGE_WORKERS = 4
+
+
+def _fetch_operations(date_from: datetime, date_to: datetime, page: int) -> tuple[list, int | None]:
+    """Операции страницы и page_count из ответа (None, если Ozon его не вернул)."""
+    data = fetch_transactions(date_from, date_to, page=page, page_size=TRANSACTIONS_PAGE_SIZE)
+    result = data.get("result") or {}
+    page_count = result.get("page_count")
+    return result.get("operations") or [], int(page_count) if page_count is not None else None
+
+
+def _store_operations(operations: list) -> int:
+    """Раскладывает операции страницы в строки order_fee_items и пишет их. Возвращает число строк."""
+    # строки страницы копим по uid и пишем одним execute_values:
+    # повтор uid внутри одного INSERT ... ON CONFLICT DO UPDATE недопустим,
+    # а последняя запись побеждает — как и при построчной вставке
+    rows: Dict[str, tuple] = {}
+    n = 0
+
+    # привязка к заказам — одним запросом на страницу
+    known_exact, known_by_prefix = preload_order_ids(_op_order_candidate(op) for op in operations)
+
+    for op in operations:
+      order_id = _op_order_candidate(op)
+      # операции без отправления (период, подписки и т.п.) — привязывать нечего
+      if order_id:
+          order_id_to_save, ext_order_id = resolve_order_id(order_id, known_exact, known_by_prefix)
+      else:
+          order_id_to_save, ext_order_id = None, None
+
+      op_date = op.get("operation_date") or op.get("date") or None
+      op_type = op.get("operation_type") or None
+      op_type_name = op.get("operation_type_name") or op_type or "UNKNOWN"
+      op_amount = _amount(op.get("amount"))
+
+      services = op.get("services") or []
+
+      # ✅ Если services пустой — пишем одну строку по операции
+      if not services:
+        fee_group = _guess_fee_group(str(op_type_name))
+        fee_name = normalize_fee_name(str(op_type_name))
+        fee_uid = make_fee_uid(
+            "finance_api",
+            order_id_to_save,
+            ext_order_id,
+            str(op_type) if op_type else None,
+            fee_group,
+            fee_name,
+            op_date,
+            None,
+        )
 
-    page = 1
-    total_rows = 0
-
-    while True:
-        data = fetch_transactions(date_from, date_to, page=page, page_size=200)
-        result = data.get("result") or {}
-        operations = result.get("operations") or []
-        # import json
-
-        # if operations:
-        #   print("=== SAMPLE OPERATION JSON ===")
-        #   print(json.dumps(operations[0], ensure_ascii=False, indent=2))
-        #   print("=== END SAMPLE OPERATION JSON ===")
-        #   return 0
-        
-        if not operations:
-            break
-
-        for op in operations:
-          # ✅ правильная привязка к заказу
-          posting = op.get("posting") or {}
-          posting_number = (
-              posting.get("posting_number")
-              or op.get("posting_number")
-              or op.get("order_id")
-              or None
-          )
-          order_id = str(posting_number).strip() if posting_number else None
-
-          # order_id_candidate = order_id
-
-          # if order_id_candidate and order_exists(order_id_candidate):
-          #     order_id_to_save = order_id_candidate
-          #     ext_order_id = None
-          # else:
-          #     order_id_to_save = None
-          #     ext_order_id = order_id_candidate
-
-          order_id_to_save, ext_order_id = resolve_order_id(order_id)
-
-          op_date = op.get("operation_date") or op.get("date") or None
-          op_type = op.get("operation_type") or None
-          op_type_name = op.get("operation_type_name") or op_type or "UNKNOWN"
-          op_amount = _dec(op.get("amount"))
-
-          services = op.get("services") or []
-
-          # ✅ Если services пустой — пишем одну строку по операции
-          if not services:
-            fee_group = _guess_fee_group(str(op_type_name))
-            fee_name = normalize_fee_name(str(op_type_name))
-            fee_uid = make_fee_uid(
-                "finance_api",
-                order_id_to_save,
-                ext_order_id,
-                str(op_type) if op_type else None,
-                fee_group,
-                fee_name,
-                op_date,
-                None,
-            )
-
-            execute_query(insert_q, (
-                fee_uid,                   # fee_uid  <-- новый параметр
-                order_id_to_save,          # order_id
-                ext_order_id,              # ext_order_id
-                fee_group,                 # fee_group
-                fee_name,                  # fee_name
-                op_amount,                 # amount
-                str(op_type) if op_type else None,  # operation_type
-                op_date,                   # occurred_at
-                None,                      # sku
-            ))
-            total_rows += 1
-            continue
-
-          # ✅ Иначе — пишем построчно по services
-          for svc in services:
-            name = svc.get("name") or svc.get("type") or "UNKNOWN"
-            amount = svc.get("price")
-            if amount is None:
-                amount = svc.get("amount")
-            amount_dec = _dec(amount)
-
-            sku = svc.get("sku") or None
-            if sku is not None:
-                try:
-                    sku = int(sku)
-                except Exception:
-                    sku = None
-
-            fee_group = _guess_fee_group(str(name))
-
-            fee_name = normalize_fee_name(str(name))
-            fee_uid = make_fee_uid(
-                "finance_api",
-                order_id_to_save,
-                ext_order_id,
-                str(op_type) if op_type else None,
-                fee_group,
-                fee_name,
-                op_date,
-                sku,
-            )
-
-            execute_query(insert_q, (
-                fee_uid,                   # fee_uid  <-- новый параметр
-                order_id_to_save,          # order_id
-                ext_order_id,              # ext_order_id
-                fee_group,                 # fee_group
-                fee_name,                  # fee_name
-                amount_dec,                # amount
-                str(op_type) if op_type else None,  # operation_type
-                op_date,                   # occurred_at
-                sku,                       # sku
-            ))
-            total_rows += 1
-
-        # пагинация
-        # Часто в ответе есть page_count/total — но чтобы не гадать, делаем простой критерий:
-        if len(operations) < 200:
-            break
-        page += 1
-
-
-    return total_rows
-
-
-def run(date_from_str: str, date_to_str: str):
-    # парсим даты
+        rows[fee_uid] = (
+            fee_uid,                   # fee_uid  <-- новый параметр
+            order_id_to_save,          # order_id
+            ext_order_id,              # ext_order_id
+            fee_group,                 # fee_group
+            fee_name,                  # fee_name
+            op_amount,                 # amount
+            str(op_type) if op_type else None,  # operation_type
+            op_date,                   # occurred_at
+            None,                      # sku
+        )
+        n += 1
+        continue
+
+      # ✅ Иначе — пишем построчно по services
+      for svc in services:
+        name = svc.get("name") or svc.get("type") or "UNKNOWN"
+        amount = svc.get("price")
+        if amount is None:
+            amount = svc.get("amount")
+        amount_dec = _amount(amount)
+
+        sku = svc.get("sku") or None
+        if sku is not None:
+            try:
+                sku = int(sku)
+            except Exception:
+                sku = None
+
+        fee_group = _guess_fee_group(str(name))
+
+        fee_name = normalize_fee_name(str(name))
+        fee_uid = make_fee_uid(
+            "finance_api",
+            order_id_to_save,
+            ext_order_id,
+            str(op_type) if op_type else None,
+            fee_group,
+            fee_name,
+            op_date,
+            sku,
+        )
+
+        rows[fee_uid] = (
+            fee_uid,                   # fee_uid  <-- новый параметр
+            order_id_to_save,          # order_id
+            ext_order_id,              # ext_order_id
+            fee_group,                 # fee_group
+            fee_name,                  # fee_name
+            amount_dec,                # amount
+            str(op_type) if op_type else None,  # operation_type
+            op_date,                   # occurred_at
+            sku,                       # sku
+        )
+        n += 1
+
+    if rows:
+        # строки из API можно перезалить — commit страницы не ждёт fsync WAL
+        with transaction(synchronous_commit=False) as cur:
+            execute_values(cur, FEE_UPSERT_SQL, list(rows.values()), template=FEE_UPSERT_TEMPLATE, page_size=500)
+
+    return n
+
+
+
+def _iter_window_pages(date_from: datetime, date_to: datetime) -> Iterator[list]:
+    """
+    Страницы операций окна [date_from; date_to] по порядку.
+
+    Первая страница — синхронно: из неё узнаём page_count. Остальные качаем
+    параллельно (PAGE_WORKERS потоков) и отдаём по одной, в порядке страниц.
+    """
+    operations, page_count = _fetch_operations(date_from, date_to, page=1)
+    if not operations:
+        return
+    yield operations
+
+    if page_count is None:
+        # page_count нет — старый критерий: идём до первой неполной страницы
+        page = 1
+        while len(operations) >= TRANSACTIONS_PAGE_SIZE:
+            page += 1
+            operations, _ = _fetch_operations(date_from, date_to, page=page)
+            if not operations:
+                break
+            yield operations
+        return
+
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as pool:
+        # map отдаёт страницы по порядку, пока следующие ещё качаются
+        yield from pool.map(
+            lambda p: _fetch_operations(date_from, date_to, page=p)[0],
+            range(2, page_count + 1),
+        )
+
+
+def load_transactions_window(date_from: datetime, date_to: datetime, pages: Optional[List[list]] = None):
+    """
+    Загружает транзакции за окно [date_from; date_to] и кладёт в order_fee_items.
+    pages — уже скачанные страницы окна (prefetch_transactions); без них качаем сами,
+    записывая каждую страницу, пока следующие ещё в пути.
+    """
+    if pages is None:
+        pages = _iter_window_pages(date_from, date_to)
+    return sum(_store_operations(operations) for operations in pages)
+
+
+def _parse_period(date_from_str: str, date_to_str: str) -> tuple[datetime, datetime]:
     date_from = datetime.strptime(date_from_str, "%Y-%m-%d")
     date_to = datetime.strptime(date_to_str, "%Y-%m-%d") + timedelta(days=1) - timedelta(seconds=1)
+    return date_from, date_to
 
-    # чистим предыдущую загрузку API
-    # execute_query("DELETE FROM order_fee_items WHERE source='finance_api';")
 
+def _windows(date_from: datetime, date_to: datetime) -> Iterator[tuple[datetime, datetime]]:
     # режем период на окна по 10 дней (ограничение метода). :contentReference[oaicite:4]{index=4}
     window = timedelta(days=10)
     cur_from = date_from
-    total = 0
-
     while cur_from <= date_to:
         cur_to = min(cur_from + window - timedelta(seconds=1), date_to)
-        print(f"[finance] Окно: {cur_from.date()} — {cur_to.date()} ...")
-        total += load_transactions_window(cur_from, cur_to)
+        yield cur_from, cur_to
         cur_from = cur_to + timedelta(seconds=1)
 
+
+def prefetch_transactions(date_from_str: str, date_to_str: str) -> List[List[list]]:
+    """
+    Только HTTP: скачивает страницы операций по всем окнам периода, в БД не пишет.
+    update_all запускает это параллельно с загрузкой заказов, а запись идёт
+    потом в run(..., prefetched=...) — привязка к orders видит уже свежие заказы.
+    """
+    return [list(_iter_window_pages(f, t)) for f, t in _windows(*_parse_period(date_from_str, date_to_str))]
+
+
+def run(date_from_str: str, date_to_str: str, prefetched: Optional[List[List[list]]] = None):
+    # парсим даты
+    date_from, date_to = _parse_period(date_from_str, date_to_str)
+
+    # чистим предыдущую загрузку API
+    # execute_query("DELETE FROM order_fee_items WHERE source='finance_api';")
+
+    total = 0
+    for i, (cur_from, cur_to) in enumerate(_windows(date_from, date_to)):
+        print(f"[finance] Окно: {cur_from.date()} — {cur_to.date()} ...")
+        pages = prefetched[i] if prefetched is not None else None
+        total += load_transactions_window(cur_from, cur_to, pages=pages)
+
     print(f"[finance] Строк в order_fee_items (finance_api): {total}")
 
     print("[finance] Пересчитываем orders...")
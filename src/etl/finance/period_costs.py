@@ -3,40 +3,23 @@
 Агрегируем периодные расходы (которые не привязаны к заказам):
 order_fee_items.source='finance_api' AND order_id IS NULL
 
+finance_period_costs — материализованное представление (см. migrations),
+агрегат считает сам Postgres при REFRESH.
+
 Запуск:
   python -m src.period_costs_etl 2025-10-01 2025-12-12
 """
 
 from src.core.db import execute_query
 
-def recalc_period_costs(date_from: str, date_to: str):
-    # 1) удаляем старые агрегаты за период (чтобы ETL был идемпотентный)
-    execute_query(
-        """
-        DELETE FROM finance_period_costs
-        WHERE (cost_date >= %s AND cost_date < %s)
-          OR cost_date IS NULL;
-        """,
-        (date_from, date_to),
-    )
-
-    # 2) вставляем агрегаты заново
-    q = """
-      INSERT INTO finance_period_costs (cost_date, fee_group, fee_name, amount)
-      SELECT
-        DATE(occurred_at) AS cost_date,
-        fee_group,
-        fee_name,
-        SUM(amount)       AS amount
-      FROM order_fee_items
-      WHERE source = 'finance_api'
-        AND order_id IS NULL
-        AND occurred_at IS NOT NULL
-        AND occurred_at >= %s
-        AND occurred_at <  %s
-      GROUP BY 1,2,3;
+def recalc_period_costs(date_from: str | None = None, date_to: str | None = None):
+    """
+    Обновляет finance_period_costs целиком: строк периодных расходов немного,
+    а полный пересчёт заодно подхватывает строки, которые позже привязались к заказам.
+    date_from / date_to оставлены для совместимости вызовов (update_all, CLI).
+    CONCURRENTLY — дашборды продолжают читать старые данные во время обновления.
     """
-    execute_query(q, (date_from, date_to))
+    execute_query("REFRESH MATERIALIZED VIEW CONCURRENTLY finance_period_costs;")
 
 if __name__ == "__main__":
     import sys
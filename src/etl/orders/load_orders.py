@@ -16,11 +16,18 @@ ETL: загрузка заказов (FBO postings) из Ozon Seller API в Post
 
 from __future__ import annotations
 
+import os
+from contextlib import nullcontext
 from datetime import datetime, timedelta
 from decimal import Decimal
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple
 
-from src.core.db import execute_query, fetch_one
+from psycopg2.extras import Json, execute_values
+
+import psycopg2
+
+from src.core.db import copy_rows, execute_query, fetch_one, get_cursor, transaction
 from src.catalog.product_catalog import PRODUCT_CATALOG
 
 # ВАЖНО:
@@ -29,21 +36,59 @@ from src.catalog.product_catalog import PRODUCT_CATALOG
 from src.ozon.seller_api import get_default_seller_client
 
 
+# 1 — перезаливать все postings периода, даже если они не менялись с прошлого запуска
+# (нужно после изменения логики разбора или PRODUCT_CATALOG)
+FULL_RELOAD = os.getenv("ETL_ORDERS_FULL_RELOAD", "0") == "1"
+
+# размер страницы /v2/posting/fbo/list (максимум у Ozon — 1000):
+# в 10 раз меньше запросов, чем по 100, и крупнее пачки на запись в БД
+POSTINGS_PAGE_SIZE = 1000
+
+
 # ---------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------
 
-def _dec(x: Any) -> Decimal:
-    if x is None:
-        return Decimal("0")
-    if isinstance(x, Decimal):
-        return x
+# sku → (flavor, grams): разворачиваем PRODUCT_CATALOG один раз при импорте,
+# чтобы в цикле по товарам был один lookup вместо get + два .get
+_PRODUCT_ATTRS = {
+    sku: (attrs.get("flavor"), attrs.get("grams")) for sku, attrs in PRODUCT_CATALOG.items()
+}
+_NO_ATTRS = (None, None)
+
+# Количество в заказе почти всегда маленькое целое — Decimal для них строим один раз
+_SMALL_DECIMALS = tuple(Decimal(i) for i in range(65))
+
+
+@lru_cache(maxsize=4096, typed=True)
+def _parse_dec(x: Any) -> Decimal:
+    # Ozon повторяет одни и те же цены ("0", "99.00"), Decimal неизменяемый — кэшируем
     # защищаемся от "1 234,56"
     s = str(x).replace(" ", "").replace(",", ".")
     try:
         return Decimal(s)
     except Exception:
-        return Decimal("0")
+        return _SMALL_DECIMALS[0]
+
+
+def _dec(x: Any) -> Decimal:
+    if x is None:
+        return _SMALL_DECIMALS[0]
+    if isinstance(x, Decimal):
+        return x
+    if type(x) is int and 0 <= x < len(_SMALL_DECIMALS):
+        return _SMALL_DECIMALS[x]
+    if isinstance(x, (str, int, float)):
+        return _parse_dec(x)
+    return _parse_dec.__wrapped__(x)
+
+
+def _exec(cur, query: str, params: tuple | None = None) -> None:
+    """На курсоре вызывающей транзакции, а без него — отдельным execute_query."""
+    if cur is None:
+        execute_query(query, params)
+    else:
+        cur.execute(query, params)
 
 
 def extract_customer_id(posting_number: str) -> str:
@@ -58,31 +103,34 @@ def extract_customer_id(posting_number: str) -> str:
     if not s:
         return "unknown"
 
-    for sep in ("-", "_"):
-        if sep in s:
-            return s.split(sep, 1)[0]
+    # partition — один проход по строке на разделитель, без отдельной проверки "in"
+    head, sep, _ = s.partition("-")
+    if sep:
+        return head
 
-    # fallback: весь posting_number как customer_id (лучше чем None)
-    return s
+    # без "_" partition вернёт всю строку:
+    # fallback — весь posting_number как customer_id (лучше чем None)
+    return s.partition("_")[0]
 
 
 # ---------------------------------------------------------------------
 # Products + Order items
 # ---------------------------------------------------------------------
 
-def sync_order_items_and_products_from_posting(posting: Dict[str, Any]) -> None:
-    """
-    Перезаписывает order_items по заказу и upsert-ит products.
-    """
-    order_id = posting.get("posting_number")
-    if not order_id:
-        print("[orders] skip order_items sync: no posting_number")
-        return
+ORDER_ITEMS_COLUMNS = ("order_id", "sku", "quantity", "price", "revenue")
+FEE_ITEMS_COLUMNS = ("order_id", "fee_group", "fee_name", "amount", "percent", "product_id", "source")
 
-    products = posting.get("products") or []
 
-    # идемпотентность: удаляем старые строки
-    execute_query("DELETE FROM order_items WHERE order_id = %s;", (order_id,))
+def _items_and_products_rows(
+    order_id: str, products: List[Dict[str, Any]]
+) -> Tuple[Dict[Any, Tuple[Any, ...]], List[Tuple[Any, ...]]]:
+    """
+    Строки products (sku → строка) и order_items по одному заказу.
+    products — уже извлечённый posting["products"].
+    """
+    # sku → строка products (один sku дважды в одном INSERT ... ON CONFLICT нельзя)
+    product_rows: Dict[Any, Tuple[Any, ...]] = {}
+    item_rows: List[Tuple[Any, ...]] = []
 
     for it in products:
         sku = it.get("sku")
@@ -93,31 +141,34 @@ def sync_order_items_and_products_from_posting(posting: Dict[str, Any]) -> None:
         qty = _dec(quantity)
         line_revenue = price * qty
 
-        attrs = PRODUCT_CATALOG.get(sku, {}) if sku is not None else {}
-        flavor = attrs.get("flavor")
-        grams = attrs.get("grams")
+        flavor, grams = _PRODUCT_ATTRS.get(sku, _NO_ATTRS)
 
-        # products upsert
-        execute_query(
-            """
-            INSERT INTO products (sku, name, flavor, grams)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (sku) DO UPDATE
-            SET name = EXCLUDED.name,
-                flavor = EXCLUDED.flavor,
-                grams = EXCLUDED.grams;
-            """,
-            (sku, name, flavor, grams),
+        product_rows[sku] = (sku, name, flavor, grams)
+        item_rows.append(
+            (order_id, sku, int(quantity) if str(quantity).isdigit() else quantity, price, line_revenue)
         )
 
-        # order_items insert
-        execute_query(
-            """
-            INSERT INTO order_items (order_id, sku, quantity, price, revenue)
-            VALUES (%s, %s, %s, %s, %s);
-            """,
-            (order_id, sku, int(quantity) if str(quantity).isdigit() else quantity, price, line_revenue),
-        )
+    return product_rows, item_rows
+
+
+def _upsert_products(cur, product_rows: List[Tuple[Any, ...]]) -> None:
+    if not product_rows:
+        return
+    execute_values(
+        cur,
+        """
+        INSERT INTO products (sku, name, flavor, grams)
+        VALUES %s
+        ON CONFLICT (sku) DO UPDATE
+        SET name = EXCLUDED.name,
+            flavor = EXCLUDED.flavor,
+            grams = EXCLUDED.grams
+        WHERE (products.name, products.flavor, products.grams)
+              IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.flavor, EXCLUDED.grams);
+        """,
+        product_rows,
+        page_size=500,
+    )
 
 
 # ---------------------------------------------------------------------
@@ -178,110 +229,244 @@ def extract_ozon_finance_from_posting(posting: Dict[str, Any]) -> Tuple[Decimal,
     return payout_total, fees_total, fee_items
 
 
-def sync_order_fee_items(order_id: str, fee_items: List[Dict[str, Any]]) -> None:
+def _fee_rows(order_id: str, fee_items: List[Dict[str, Any]]) -> List[Tuple[Any, ...]]:
+    return [
+        (
+            order_id,
+            it.get("fee_group"),
+            it.get("fee_name"),
+            it.get("amount"),
+            it.get("percent"),
+            it.get("product_id"),
+            it.get("source", "posting_financial"),
+        )
+        for it in fee_items
+    ]
+
+
+# ---------------------------------------------------------------------
+# Orders upsert
+# ---------------------------------------------------------------------
+
+def recalc_orders_revenue(cur, order_ids: List[str]) -> None:
     """
-    Перезаписываем детализацию удержаний по заказу (идемпотентность).
-    Пишем только source='posting_financial'.
+    Выручка заказа = SUM(order_items.revenue) — считаем в Postgres по уже записанным строкам.
+    Пишем только изменившиеся значения (IS DISTINCT FROM), заказы без строк → 0.
     """
-    execute_query(
-        "DELETE FROM order_fee_items WHERE order_id = %s AND source = 'posting_financial';",
-        (order_id,),
+    cur.execute(
+        """
+        UPDATE orders o
+        SET revenue = r.revenue
+        FROM (
+            SELECT ids.order_id, COALESCE(SUM(oi.revenue), 0) AS revenue
+            FROM unnest(%s::text[]) AS ids(order_id)
+            LEFT JOIN order_items oi ON oi.order_id = ids.order_id
+            GROUP BY ids.order_id
+        ) r
+        WHERE o.order_id = r.order_id
+          AND o.revenue IS DISTINCT FROM r.revenue;
+        """,
+        (order_ids,),
     )
 
-    q = """
-    INSERT INTO order_fee_items (order_id, fee_group, fee_name, amount, percent, product_id, source)
-    VALUES (%s, %s, %s, %s, %s, %s, %s);
+
+def upsert_orders_from_postings(postings: List[Dict[str, Any]], cur=None) -> List[str]:
     """
+    Пишет пачку postings в БД одной транзакцией.
 
-    for it in fee_items:
-        execute_query(
-            q,
-            (
-                order_id,
-                it.get("fee_group"),
-                it.get("fee_name"),
-                it.get("amount"),
-                it.get("percent"),
-                it.get("product_id"),
-                it.get("source", "posting_financial"),
-            ),
+    Два прохода:
+    1) разбираем все postings в Python в плоские строки по таблицам;
+    2) по одному запросу на таблицу: execute_values для upsert-ов
+       (customers, orders, products) и COPY для order_items / order_fee_items
+       (после DELETE по этим заказам это чистая вставка);
+       выручку заказов досчитываем в SQL по order_items.
+
+    Возвращает order_id всех записанных заказов.
+    cur — курсор вызывающей транзакции; если не передан, открываем свою.
+    """
+    # order_id → строки заказа; если posting пришёл дважды — берём последний
+    parsed: Dict[str, Tuple[Tuple[Any, ...], Dict[Any, Tuple[Any, ...]], List[Tuple[Any, ...]], List[Tuple[Any, ...]]]] = {}
+
+    for posting in postings:
+        order_id = posting.get("posting_number")
+        if not order_id:
+            print("[orders] skip posting without posting_number")
+            continue
+        order_id = str(order_id)
+
+        customer_id = extract_customer_id(order_id)
+        order_date = posting.get("in_process_at")
+        status = posting.get("status")
+
+        # ozon_fees_total / ozon_payout заказа считает recalc_orders_finance по order_fee_items —
+        # отсюда берём только сами строки удержаний
+        _, _, fee_items = extract_ozon_finance_from_posting(posting)
+        product_rows, item_rows = _items_and_products_rows(order_id, posting.get("products") or ())
+
+        parsed[order_id] = (
+            (order_id, customer_id, order_date, status),
+            product_rows,
+            item_rows,
+            _fee_rows(order_id, fee_items),
         )
 
+    if not parsed:
+        return []
+
+    order_ids = list(parsed)
+    order_rows = [v[0] for v in parsed.values()]
+    customer_rows = [(c,) for c in dict.fromkeys(r[1] for r in order_rows)]
+
+    product_rows: Dict[Any, Tuple[Any, ...]] = {}
+    item_rows: List[Tuple[Any, ...]] = []
+    fee_rows: List[Tuple[Any, ...]] = []
+    for _, products, items, fees in parsed.values():
+        product_rows.update(products)
+        item_rows.extend(items)
+        fee_rows.extend(fees)
+
+    with nullcontext(cur) if cur is not None else get_cursor(commit=True) as cur:
+        # гарантируем customers
+        execute_values(
+            cur,
+            "INSERT INTO customers (customer_id) VALUES %s ON CONFLICT (customer_id) DO NOTHING;",
+            customer_rows,
+            page_size=1000,
+        )
 
-# ---------------------------------------------------------------------
-# Orders upsert
-# ---------------------------------------------------------------------
+        execute_values(
+            cur,
+            """
+            INSERT INTO orders (
+                order_id, customer_id, order_date, status,
+                campaign, is_first_order
+            )
+            VALUES %s
+            ON CONFLICT (order_id) DO UPDATE
+            SET
+                customer_id = EXCLUDED.customer_id,
+                order_date  = EXCLUDED.order_date,
+                status      = EXCLUDED.status
+            -- не плодим новую версию строки, если ничего не поменялось
+            -- (финансовые колонки тут не пишем — ими владеет recalc_orders_finance)
+            WHERE (orders.customer_id, orders.order_date, orders.status)
+                  IS DISTINCT FROM
+                  (EXCLUDED.customer_id, EXCLUDED.order_date, EXCLUDED.status);
+            """,
+            order_rows,
+            template="(%s, %s, %s, %s, NULL, NULL)",
+            page_size=1000,
+        )
 
-def calculate_order_revenue(posting: Dict[str, Any]) -> Decimal:
-    """
-    Простой расчёт выручки: sum(price * quantity) по posting.products.
-    """
-    products = posting.get("products") or []
-    total = Decimal("0")
-    for it in products:
-        total += _dec(it.get("price")) * _dec(it.get("quantity") or 0)
-    return total
+        # идемпотентность: перезаписываем детализацию по этим заказам
+        cur.execute(
+            "DELETE FROM order_fee_items WHERE order_id = ANY(%s) AND source = 'posting_financial';",
+            (order_ids,),
+        )
+        cur.execute("DELETE FROM order_items WHERE order_id = ANY(%s);", (order_ids,))
+
+        _upsert_products(cur, list(product_rows.values()))
+
+        if fee_rows:
+            copy_rows(cur, "order_fee_items", FEE_ITEMS_COLUMNS, fee_rows)
+        if item_rows:
+            copy_rows(cur, "order_items", ORDER_ITEMS_COLUMNS, item_rows)
+
+        recalc_orders_revenue(cur, order_ids)
+
+    return order_ids
 
 
 def upsert_order_from_posting(posting: Dict[str, Any]) -> None:
-    order_id = posting.get("posting_number")
-    if not order_id:
-        print("[orders] skip posting without posting_number")
-        return
+    """
+    Один заказ: то же, что upsert_orders_from_postings для пачки из одного posting.
+    """
+    upsert_orders_from_postings([posting])
 
-    customer_id = extract_customer_id(str(order_id))
 
-    # гарантируем customer
-    execute_query(
-        """
-        INSERT INTO customers (customer_id)
-        VALUES (%s)
-        ON CONFLICT (customer_id) DO NOTHING;
-        """,
-        (customer_id,),
-    )
+# ---------------------------------------------------------------------
+# Raw postings (delta ETL)
+# ---------------------------------------------------------------------
 
-    in_process_at = posting.get("in_process_at")
-    order_date = in_process_at if in_process_at is not None else None
-    status = posting.get("status")
+def store_raw_postings(cur, postings: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Сохраняет сырые postings в postings_raw и возвращает только новые/изменившиеся.
+
+    Сравнение — по JSONB целиком (IS DISTINCT FROM): если Ozon отдал тот же posting,
+    что и в прошлый раз, строка не обновляется и заново не разбирается.
+    """
+    by_number: Dict[str, Dict[str, Any]] = {}
+    for p in postings:
+        number = p.get("posting_number")
+        if number:
+            by_number[str(number)] = p  # дубль в одной пачке → берём последний
 
-    revenue = calculate_order_revenue(posting)
-    ozon_payout, ozon_fees_total, fee_items = extract_ozon_finance_from_posting(posting)
+    if not by_number:
+        return []
 
-    execute_query(
+    changed = execute_values(
+        cur,
         """
-        INSERT INTO orders (
-            order_id, customer_id, order_date, status,
-            revenue, ozon_fees_total, ozon_payout,
-            campaign, is_first_order
-        )
-        VALUES (%s, %s, %s, %s, %s, %s, %s, NULL, NULL)
-        ON CONFLICT (order_id) DO UPDATE
-        SET
-            customer_id     = EXCLUDED.customer_id,
-            order_date      = EXCLUDED.order_date,
-            status          = EXCLUDED.status,
-            revenue         = EXCLUDED.revenue,
-            ozon_fees_total = EXCLUDED.ozon_fees_total,
-            ozon_payout     = EXCLUDED.ozon_payout;
+        INSERT INTO postings_raw (posting_number, payload, fetched_at)
+        VALUES %s
+        ON CONFLICT (posting_number) DO UPDATE
+        SET payload = EXCLUDED.payload,
+            fetched_at = EXCLUDED.fetched_at
+        WHERE postings_raw.payload IS DISTINCT FROM EXCLUDED.payload
+        RETURNING posting_number;
         """,
-        (order_id, customer_id, order_date, status, revenue, ozon_fees_total, ozon_payout),
+        [(number, Json(p)) for number, p in by_number.items()],
+        template="(%s, %s, now())",
+        page_size=500,
+        fetch=True,
     )
-
-    # детализация удержаний
-    sync_order_fee_items(str(order_id), fee_items)
-
-    # строки заказа + каталог
-    sync_order_items_and_products_from_posting(posting)
+    return [by_number[row[0]] for row in changed]
 
 
 # ---------------------------------------------------------------------
 # Recalc агрегатов
 # ---------------------------------------------------------------------
 
-def recalc_customers_aggregates() -> None:
-    execute_query(
-        """
+def _customers_filter(customer_ids: Optional[List[str]]) -> Tuple[str, tuple]:
+    """Доп. условие "только эти клиенты" (None — все клиенты)."""
+    if customer_ids is None:
+        return "", ()
+    return "AND customer_id = ANY(%s::text[])", (list(customer_ids),)
+
+
+def recalc_customers_and_first_orders(customer_ids: Optional[List[str]] = None, cur=None) -> None:
+    """
+    Пересчёт агрегатов customers и флагов is_first_order одним запросом:
+    orders по этим клиентам читаются один раз, из одного CTE пишутся и флаги
+    is_first_order (data-modifying CTE), и агрегаты customers.
+    is_first_order = заказ в самую раннюю дату клиента (при равных датах — все такие);
+    переписываются только строки, где значение реально изменилось.
+    customer_ids — пересчитать только этих клиентов (None — всех).
+    cur — курсор вызывающей транзакции (None — отдельная транзакция).
+    """
+    only_sql, params = _customers_filter(customer_ids)
+    _exec(
+        cur,
+        f"""
+        WITH o AS (
+            SELECT
+                order_id,
+                customer_id,
+                order_date,
+                revenue,
+                is_first_order,
+                order_date = MIN(order_date) OVER (PARTITION BY customer_id) AS is_first
+            FROM orders
+            WHERE customer_id IS NOT NULL
+              {only_sql}
+        ),
+        flags AS (
+            UPDATE orders t
+            SET is_first_order = o.is_first
+            FROM o
+            WHERE t.order_id = o.order_id
+              AND o.is_first_order IS DISTINCT FROM o.is_first
+        )
         INSERT INTO customers (customer_id, first_order_date, last_order_date, orders_count, total_revenue)
         SELECT
             customer_id,
@@ -289,130 +474,140 @@ def recalc_customers_aggregates() -> None:
             MAX(order_date)::date AS last_order_date,
             COUNT(*)              AS orders_count,
             SUM(revenue)          AS total_revenue
-        FROM orders
-        WHERE customer_id IS NOT NULL
+        FROM o
         GROUP BY customer_id
         ON CONFLICT (customer_id) DO UPDATE
         SET
             first_order_date = EXCLUDED.first_order_date,
             last_order_date  = EXCLUDED.last_order_date,
             orders_count     = EXCLUDED.orders_count,
-            total_revenue    = EXCLUDED.total_revenue;
-        """
+            total_revenue    = EXCLUDED.total_revenue
+        WHERE (customers.first_order_date, customers.last_order_date,
+               customers.orders_count, customers.total_revenue)
+              IS DISTINCT FROM
+              (EXCLUDED.first_order_date, EXCLUDED.last_order_date,
+               EXCLUDED.orders_count, EXCLUDED.total_revenue);
+        """,
+        params,
     )
 
 
-def recalc_is_first_order_flags() -> None:
-    execute_query(
-        """
-        WITH first_orders AS (
-            SELECT customer_id, MIN(order_date) AS first_order_date
-            FROM orders
-            WHERE customer_id IS NOT NULL AND order_date IS NOT NULL
-            GROUP BY customer_id
-        )
-        UPDATE orders o
-        SET is_first_order = (o.order_date = f.first_order_date)
-        FROM first_orders f
-        WHERE o.customer_id = f.customer_id;
-        """
-    )
+def refresh_customer_cohorts() -> None:
+    """
+    Обновляет материализованное представление customer_cohort_month
+    (когорты по месяцу первого заказа для дашбордов).
+    CONCURRENTLY — дашборды продолжают читать старые данные во время обновления.
+    """
+    execute_query("REFRESH MATERIALIZED VIEW CONCURRENTLY customer_cohort_month;")
 
 
-def recalc_orders_finance() -> None:
+def recalc_orders_finance(cur=None) -> None:
     """
     Пересчёт финансов по order_fee_items:
     - sales_report = сумма по fee_group='Продажи'
     - ozon_fees_total = сумма по всем (кроме дублирующей комиссии из finance_api)
-    - ozon_payout = revenue + ozon_fees_total
+    - разложение удержаний по группам (доставка, эквайринг, реклама, комиссия, скидки, прочее)
+    - ozon_payout = profit = revenue + ozon_fees_total
+
+    Всё одним UPDATE за один проход по order_fee_items; строки orders,
+    где ничего не поменялось, не переписываем.
+    Заказы без строк "Продажи" / без удержаний сохраняют прежние sales_report / удержания.
+    cur — курсор вызывающей транзакции (None — отдельная транзакция).
     """
-    execute_query(
+    _exec(
+        cur,
         """
-        UPDATE orders o
-        SET sales_report = COALESCE(s.sales, 0)
-        FROM (
-            SELECT order_id, SUM(amount) AS sales
+        WITH fee AS (
+            SELECT
+                order_id,
+                fee_group,
+                amount,
+                NOT (source='finance_api' AND fee_group='Вознаграждение Ozon') AS counted
             FROM order_fee_items
             WHERE order_id IS NOT NULL
-              AND fee_group = 'Продажи'
-            GROUP BY order_id
-        ) s
-        WHERE o.order_id = s.order_id;
-        """
-    )
+        ),
+        agg AS (
+            SELECT
+                order_id,
 
-    execute_query(
-        """
-        UPDATE orders o
-        SET ozon_fees_total = COALESCE(f.fees, 0)
-        FROM (
-            SELECT order_id, SUM(amount) AS fees
-            FROM order_fee_items
-            WHERE order_id IS NOT NULL
-              AND NOT (source='finance_api' AND fee_group='Вознаграждение Ozon')
+                SUM(amount) FILTER (WHERE fee_group = 'Продажи') AS sales,
+                COUNT(*)    FILTER (WHERE fee_group = 'Продажи') AS sales_rows,
+
+                COUNT(*)    FILTER (WHERE counted) AS fee_rows,
+                SUM(amount) FILTER (WHERE counted) AS fees_total,
+
+                SUM(amount) FILTER (WHERE counted AND fee_group = 'Услуги доставки')       AS delivery_fee,
+                SUM(amount) FILTER (WHERE counted AND fee_group = 'Услуги агентов')        AS acquiring_fee,
+                SUM(amount) FILTER (WHERE counted AND fee_group = 'Продвижение и реклама') AS ads_fee,
+
+                SUM(amount) FILTER (WHERE counted AND fee_group = 'Вознаграждение Ozon') AS sale_commission,
+                SUM(amount) FILTER (WHERE counted AND fee_group = 'Скидки')              AS discount_fee,
+
+                SUM(amount) FILTER (
+                    WHERE counted AND fee_group NOT IN (
+                        'Услуги доставки',
+                        'Услуги агентов',
+                        'Продвижение и реклама',
+                        'Вознаграждение Ozon',
+                        'Скидки'
+                    )
+                ) AS other_fee_real
+            FROM fee
             GROUP BY order_id
-        ) f
-        WHERE o.order_id = f.order_id;
-        """
-    )
-
-    execute_query(
-        """
-        UPDATE orders
-        SET ozon_payout = COALESCE(revenue, 0) + COALESCE(ozon_fees_total, 0);
-        """
-    )
-
-
-def recalc_orders_fees_breakdown() -> None:
-    """
-    Разложение комиссий по группам и profit.
-    """
-    execute_query(
-        """
-        WITH sums AS (
-          SELECT
-            order_id,
-
-            SUM(amount) AS fees_total,
-
-            SUM(CASE WHEN fee_group='Услуги доставки' THEN amount ELSE 0 END)  AS delivery_fee,
-            SUM(CASE WHEN fee_group='Услуги агентов' THEN amount ELSE 0 END)   AS acquiring_fee,
-            SUM(CASE WHEN fee_group='Продвижение и реклама' THEN amount ELSE 0 END) AS ads_fee,
-
-            SUM(CASE WHEN fee_group='Вознаграждение Ozon' THEN amount ELSE 0 END) AS sale_commission,
-            SUM(CASE WHEN fee_group='Скидки' THEN amount ELSE 0 END) AS discount_fee,
-
-            SUM(CASE
-                  WHEN fee_group NOT IN (
-                    'Услуги доставки',
-                    'Услуги агентов',
-                    'Продвижение и реклама',
-                    'Вознаграждение Ozon',
-                    'Скидки'
-                  )
-                  THEN amount ELSE 0
-                END) AS other_fee_real
-
-          FROM order_fee_items
-          WHERE order_id IS NOT NULL
-            AND NOT (source='finance_api' AND fee_group='Вознаграждение Ozon')
-          GROUP BY order_id
+        ),
+        calc AS (
+            SELECT
+                o.order_id,
+                o.revenue,
+
+                CASE WHEN a.sales_rows > 0 THEN COALESCE(a.sales, 0) ELSE o.sales_report END AS sales_report,
+
+                CASE WHEN a.fee_rows > 0 THEN COALESCE(a.fees_total, 0)      ELSE o.ozon_fees_total      END AS ozon_fees_total,
+                CASE WHEN a.fee_rows > 0 THEN COALESCE(a.delivery_fee, 0)    ELSE o.ozon_delivery_fee    END AS ozon_delivery_fee,
+                CASE WHEN a.fee_rows > 0 THEN COALESCE(a.acquiring_fee, 0)   ELSE o.ozon_acquiring_fee   END AS ozon_acquiring_fee,
+                CASE WHEN a.fee_rows > 0 THEN COALESCE(a.ads_fee, 0)         ELSE o.ozon_ads_fee         END AS ozon_ads_fee,
+                CASE WHEN a.fee_rows > 0 THEN COALESCE(a.sale_commission, 0) ELSE o.ozon_sale_commission END AS ozon_sale_commission,
+                CASE WHEN a.fee_rows > 0 THEN COALESCE(a.discount_fee, 0)    ELSE o.ozon_discount        END AS ozon_discount,
+                CASE WHEN a.fee_rows > 0 THEN COALESCE(a.other_fee_real, 0)  ELSE o.ozon_other_fee_real  END AS ozon_other_fee_real,
+
+                CASE
+                    WHEN a.fee_rows > 0 THEN COALESCE(o.revenue, 0) + COALESCE(a.fees_total, 0)
+                    ELSE o.profit
+                END AS profit
+            FROM orders o
+            LEFT JOIN agg a ON a.order_id = o.order_id
+        ),
+        new_vals AS (
+            SELECT
+                c.*,
+                COALESCE(c.revenue, 0) + COALESCE(c.ozon_fees_total, 0) AS ozon_payout
+            FROM calc c
         )
         UPDATE orders o
         SET
-          ozon_fees_total        = COALESCE(s.fees_total, 0),
-          ozon_delivery_fee      = COALESCE(s.delivery_fee, 0),
-          ozon_acquiring_fee     = COALESCE(s.acquiring_fee, 0),
-          ozon_ads_fee           = COALESCE(s.ads_fee, 0),
-
-          ozon_sale_commission   = COALESCE(s.sale_commission, 0),
-          ozon_discount          = COALESCE(s.discount_fee, 0),
-          ozon_other_fee_real    = COALESCE(s.other_fee_real, 0),
-
-          profit                 = COALESCE(o.revenue, 0) + COALESCE(s.fees_total, 0)
-        FROM sums s
-        WHERE o.order_id = s.order_id;
+            sales_report         = n.sales_report,
+            ozon_fees_total      = n.ozon_fees_total,
+            ozon_delivery_fee    = n.ozon_delivery_fee,
+            ozon_acquiring_fee   = n.ozon_acquiring_fee,
+            ozon_ads_fee         = n.ozon_ads_fee,
+            ozon_sale_commission = n.ozon_sale_commission,
+            ozon_discount        = n.ozon_discount,
+            ozon_other_fee_real  = n.ozon_other_fee_real,
+            profit               = n.profit,
+            ozon_payout          = n.ozon_payout
+        FROM new_vals n
+        WHERE o.order_id = n.order_id
+          AND (
+                o.sales_report, o.ozon_fees_total,
+                o.ozon_delivery_fee, o.ozon_acquiring_fee, o.ozon_ads_fee,
+                o.ozon_sale_commission, o.ozon_discount, o.ozon_other_fee_real,
+                o.profit, o.ozon_payout
+              ) IS DISTINCT FROM (
+                n.sales_report, n.ozon_fees_total,
+                n.ozon_delivery_fee, n.ozon_acquiring_fee, n.ozon_ads_fee,
+                n.ozon_sale_commission, n.ozon_discount, n.ozon_other_fee_real,
+                n.profit, n.ozon_payout
+              );
         """
     )
 
@@ -421,40 +616,48 @@ def recalc_orders_fees_breakdown() -> None:
 # Missing marking (optional)
 # ---------------------------------------------------------------------
 
-def mark_missing_orders_in_window(date_from: datetime, date_to: datetime, seen_order_ids: List[str]) -> None:
+def mark_missing_orders_in_window(
+    date_from: datetime, date_to: datetime, seen_order_ids: List[str], cur=None
+) -> None:
     """
     Отмечает ozon_missing для заказов в окне, которые не пришли из API.
     Требует колонок:
       orders.ozon_missing BOOLEAN
       orders.ozon_missing_at TIMESTAMP
     """
-    # 1) увиденные — точно не missing
-    if seen_order_ids:
-        execute_query(
+    # Тысячи id в ANY(%s) планировщик проверяет по одному; из временной таблицы
+    # (COPY + ANALYZE) он строит hash join / hash anti join.
+    # cur — курсор вызывающей транзакции (None — отдельная транзакция).
+    with nullcontext(cur) if cur is not None else get_cursor(commit=True) as cur:
+        cur.execute("DROP TABLE IF EXISTS seen_postings;")
+        cur.execute("CREATE TEMP TABLE seen_postings (order_id text PRIMARY KEY) ON COMMIT DROP;")
+        copy_rows(cur, "seen_postings", ("order_id",), [(oid,) for oid in set(seen_order_ids)])
+        cur.execute("ANALYZE seen_postings;")
+
+        # 1) увиденные — точно не missing (строки, где и так всё верно, не трогаем)
+        cur.execute(
             """
-            UPDATE orders
+            UPDATE orders o
             SET ozon_missing = false,
                 ozon_missing_at = NULL
-            WHERE order_id = ANY(%s);
-            """,
-            (seen_order_ids,),
+            FROM seen_postings s
+            WHERE o.order_id = s.order_id
+              AND (o.ozon_missing IS DISTINCT FROM false OR o.ozon_missing_at IS NOT NULL);
+            """
         )
 
-    # 2) те, что в окне по order_date, но не пришли — missing
-    execute_query(
-        """
-        UPDATE orders
-        SET ozon_missing = true,
-            ozon_missing_at = NOW()
-        WHERE order_date >= %s
-          AND order_date < %s
-          AND (
-            %s = '{}'::text[]
-            OR NOT (order_id = ANY(%s))
-          );
-        """,
-        (date_from, date_to, seen_order_ids, seen_order_ids),
-    )
+        # 2) те, что в окне по order_date, но не пришли — missing
+        cur.execute(
+            """
+            UPDATE orders o
+            SET ozon_missing = true,
+                ozon_missing_at = NOW()
+            WHERE o.order_date >= %s
+              AND o.order_date < %s
+              AND NOT EXISTS (SELECT 1 FROM seen_postings s WHERE s.order_id = o.order_id);
+            """,
+            (date_from, date_to),
+        )
 
 
 # ---------------------------------------------------------------------
@@ -465,30 +668,55 @@ def load_fbo_orders_for_period(date_from: datetime, date_to: datetime) -> None:
     client = get_default_seller_client()
 
     print(f"[orders] load FBO postings: {date_from} .. {date_to}")
-    postings = client.get_postings_fbo(date_from=date_from, date_to=date_to, limit=100)
-    print(f"[orders] postings fetched: {len(postings)}")
 
     seen_order_ids: List[str] = []
+    upserted: List[Dict[str, Any]] = []
+    fetched = 0
+
+    # Весь шаг — одна транзакция и один commit: postings_raw, заказы, пометки и пересчёты.
+    # Если что-то упадёт, откатится всё, и в следующий раз postings разберутся заново.
+    # synchronous_commit=off: данные воспроизводимы из API, fsync на commit не ждём.
+    with transaction(synchronous_commit=False) as cur:
+        # Пишем постранично: пока страница уходит в БД, клиент уже качает следующую волну.
+        for page in client.iter_postings_fbo(date_from=date_from, date_to=date_to, limit=POSTINGS_PAGE_SIZE):
+            fetched += len(page)
+            seen_order_ids.extend(str(p["posting_number"]) for p in page if p.get("posting_number"))
+
+            if FULL_RELOAD:
+                store_raw_postings(cur, page)
+                to_upsert = page
+            else:
+                to_upsert = store_raw_postings(cur, page)
+
+            # по одному запросу на таблицу
+            upsert_orders_from_postings(to_upsert, cur=cur)
+            upserted.extend(to_upsert)
+
+        print(f"[orders] postings fetched: {fetched}")
+        print(f"[orders] postings new/changed: {len(upserted)} (full_reload={int(FULL_RELOAD)})")
+
+        # опционально: помечаем пропавшие в пределах окна
+        # (если у тебя в миграциях добавлены ozon_missing/ozon_missing_at)
+        # savepoint — чтобы ошибка здесь не ломала всю транзакцию
+        cur.execute("SAVEPOINT mark_missing;")
+        try:
+            mark_missing_orders_in_window(date_from, date_to, seen_order_ids, cur=cur)
+            cur.execute("RELEASE SAVEPOINT mark_missing;")
+        except psycopg2.Error as e:
+            # не валим ETL, если колонок ещё нет
+            cur.execute("ROLLBACK TO SAVEPOINT mark_missing;")
+            print(f"[orders] missing marking skipped: {e}")
+
+        # агрегаты клиентов меняются только у тех, чьи заказы мы только что записали
+        touched_customers = sorted({
+            extract_customer_id(str(p["posting_number"])) for p in upserted if p.get("posting_number")
+        })
+
+        print(f"[orders] recalc customers / first order flags ({len(touched_customers)} customers) / finance ...")
+        if touched_customers:
+            recalc_customers_and_first_orders(touched_customers, cur=cur)
+        recalc_orders_finance(cur=cur)
 
-    for p in postings:
-        order_id = p.get("posting_number")
-        if order_id:
-            seen_order_ids.append(str(order_id))
-        upsert_order_from_posting(p)
-
-    # опционально: помечаем пропавшие в пределах окна
-    # (если у тебя в миграциях добавлены ozon_missing/ozon_missing_at)
-    try:
-        mark_missing_orders_in_window(date_from, date_to, seen_order_ids)
-    except Exception as e:
-        # не валим ETL, если колонок ещё нет
-        print(f"[orders] missing marking skipped: {e}")
-
-    print("[orders] recalc customers / first order flags / finance ...")
-    recalc_customers_aggregates()
-    recalc_is_first_order_flags()
-    recalc_orders_finance()
-    recalc_orders_fees_breakdown()
     print("[orders] OK ✅")
 
 
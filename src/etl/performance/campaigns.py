@@ -1,71 +1,75 @@
 from __future__ import annotations
 
-import requests
+import json
 from datetime import datetime
 
-from src.core.config import settings
-from src.core.db import execute_query
-
-from psycopg2.extras import Json
+from src.core.db import copy_rows, transaction
+from src.core.http import SESSION, json_loads
+from src.ozon.performance_api import get_perf_token as get_token
 
 BASE = "https://api-performance.ozon.ru"
 
-
-def get_token() -> str:
-    r = requests.post(
-        f"{BASE}/api/client/token",
-        json={
-            "client_id": settings.OZON_PERF_CLIENT_ID,
-            "client_secret": settings.OZON_PERF_CLIENT_SECRET,
-            "grant_type": "client_credentials",
-        },
-        timeout=60,
-    )
-    r.raise_for_status()
-    return r.json()["access_token"]
+CAMPAIGN_COLUMNS = (
+    "campaign_id", "title", "state", "adv_object_type",
+    "payment_type", "created_at", "updated_at", "raw",
+)
 
 
 def load_campaigns():
     token = get_token()
-    r = requests.get(
+    r = SESSION.get(
         f"{BASE}/api/client/campaign",
         headers={"Authorization": f"Bearer {token}"},
         timeout=60,
     )
     r.raise_for_status()
 
-    data = r.json()
+    data = json_loads(r.content)
     campaigns = data.get("list") or []
 
-    q = """
-    INSERT INTO perf_campaigns (
-        campaign_id, title, state, adv_object_type,
-        payment_type, created_at, updated_at, raw
-    )
-    VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-    ON CONFLICT (campaign_id) DO UPDATE
-    SET
-        title = EXCLUDED.title,
-        state = EXCLUDED.state,
-        adv_object_type = EXCLUDED.adv_object_type,
-        payment_type = EXCLUDED.payment_type,
-        updated_at = EXCLUDED.updated_at,
-        raw = EXCLUDED.raw;
-    """
+    rows = [
+        (
+            c["id"],
+            c.get("title"),
+            c.get("state"),
+            c.get("advObjectType"),
+            c.get("PaymentType"),
+            c.get("createdAt"),
+            c.get("updatedAt"),
+            json.dumps(c, ensure_ascii=False),
+        )
+        for c in campaigns
+    ]
 
-    for c in campaigns:
-        execute_query(
-            q,
-            (
-                c["id"],
-                c.get("title"),
-                c.get("state"),
-                c.get("advObjectType"),
-                c.get("PaymentType"),
-                c.get("createdAt"),
-                c.get("updatedAt"),
-                Json(c),
-            ),
+    # COPY во временную таблицу + один INSERT ... SELECT ... ON CONFLICT
+    # вместо INSERT на каждую кампанию; каталог перезаливается из API — без ожидания fsync
+    with transaction(synchronous_commit=False) as cur:
+        cur.execute(
+            "CREATE TEMP TABLE tmp_perf_campaigns (LIKE perf_campaigns INCLUDING DEFAULTS) ON COMMIT DROP;"
+        )
+        copy_rows(cur, "tmp_perf_campaigns", CAMPAIGN_COLUMNS, rows)
+        cur.execute(
+            """
+            INSERT INTO perf_campaigns (
+                campaign_id, title, state, adv_object_type,
+                payment_type, created_at, updated_at, raw
+            )
+            SELECT DISTINCT ON (campaign_id)
+                campaign_id, title, state, adv_object_type,
+                payment_type, created_at, updated_at, raw
+            FROM tmp_perf_campaigns
+            ON CONFLICT (campaign_id) DO UPDATE
+            SET
+                title = EXCLUDED.title,
+                state = EXCLUDED.state,
+                adv_object_type = EXCLUDED.adv_object_type,
+                payment_type = EXCLUDED.payment_type,
+                updated_at = EXCLUDED.updated_at,
+                raw = EXCLUDED.raw
+            -- raw — весь JSON кампании, остальные колонки выводятся из него:
+            -- неизменившиеся кампании не переписываем (ни строку, ни TOAST с raw)
+            WHERE perf_campaigns.raw IS DISTINCT FROM EXCLUDED.raw;
+            """
         )
 
     print(f"[perf] campaigns loaded: {len(campaigns)}")
@@ -2,43 +2,38 @@ from __future__ import annotations
 
 from datetime import datetime, timedelta
 from decimal import Decimal
-import requests
+import os
 
-from src.core.config import settings
-from src.core.db import execute_query
+from psycopg2.extras import execute_values
+
+from src.core.db import fetch_one, transaction
+from src.core.http import SESSION, json_loads
+from src.ozon.performance_api import get_perf_token as get_token
 
 BASE = "https://api-performance.ozon.ru"
 
+# "1 234,56" → "1234.56" одним translate; Ozon иногда ставит неразрывный пробел
+_DEC_TRANS = str.maketrans({" ": None, "\u00a0": None, ",": "."})
+_ZERO = Decimal("0")
+
 def _dec_ru(x: str | None) -> Decimal:
     if not x:
-        return Decimal("0")
-    return Decimal(str(x).replace(" ", "").replace(",", "."))
-
-def get_token() -> str:
-    r = requests.post(
-        f"{BASE}/api/client/token",
-        json={
-            "client_id": settings.OZON_PERF_CLIENT_ID,
-            "client_secret": settings.OZON_PERF_CLIENT_SECRET,
-            "grant_type": "client_credentials",
-        },
-        timeout=30,
-    )
-    r.raise_for_status()
-    return r.json()["access_token"]
+        return _ZERO
+    return Decimal((x if isinstance(x, str) else str(x)).translate(_DEC_TRANS))
 
 def fetch_daily_json(date_from: str, date_to: str) -> dict:
     token = get_token()
     headers = {"Authorization": f"Bearer {token}"}
     params = {"dateFrom": date_from, "dateTo": date_to}
-    r = requests.get(
+    r = SESSION.get(
         f"{BASE}/api/client/statistics/daily/json",
         headers=headers,
         params=params,
         timeout=90,
     )
     r.raise_for_status()
-    return r.json()
+    # ответ на весь период бывает в мегабайты — разбираем через json_loads (orjson)
+    return json_loads(r.content)
 
 def load_daily(date_from: str, date_to: str) -> int:
     data = fetch_daily_json(date_from, date_to)
@@ -49,7 +44,7 @@ def load_daily(date_from: str, date_to: str) -> int:
       campaign_id, campaign_title, stat_date,
       impressions, clicks, spend, avg_bid, orders_cnt, orders_amount
     )
-    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
+    VALUES %s
     ON CONFLICT (campaign_id, stat_date) DO UPDATE SET
       campaign_title = EXCLUDED.campaign_title,
       impressions    = EXCLUDED.impressions,
@@ -60,10 +55,13 @@ def load_daily(date_from: str, date_to: str) -> int:
       orders_amount  = EXCLUDED.orders_amount;
     """
 
-    n = 0
+    # (campaign_id, stat_date) → строка: повтор ключа в одном
+    # INSERT ... ON CONFLICT DO UPDATE недопустим, последняя строка побеждает
+    values = {}
     for r in rows:
-        campaign_id    = str(r.get("id") or "").strip()
-        if not campaign_id:
+        try:
+            campaign_id = int(r["id"])
+        except (KeyError, TypeError, ValueError):
             continue
         campaign_title = (r.get("title") or "").strip()
         stat_date      = datetime.strptime(r["date"], "%Y-%m-%d").date()
@@ -75,21 +73,45 @@ def load_daily(date_from: str, date_to: str) -> int:
         orders_cnt     = int(r.get("orders") or 0)
         orders_amount  = _dec_ru(r.get("ordersMoney"))
 
-        execute_query(upsert_q, (
+        values[(campaign_id, stat_date)] = (
             campaign_id, campaign_title, stat_date,
             impressions, clicks, spend, avg_bid, orders_cnt, orders_amount
-        ))
-        n += 1
+        )
+
+    # всё окно — одним execute_values и одним commit (без ожидания fsync: данные из API)
+    if values:
+        with transaction(synchronous_commit=False) as cur:
+            execute_values(cur, upsert_q, list(values.values()), page_size=500)
 
-    return n
+    return len(values)
 
 MAX_WINDOW_DAYS = 30  # безопасно (если лимит 62)
+# сколько последних уже загруженных дней перекачиваем: Ozon досчитывает статистику задним числом
+RESUME_OVERLAP_DAYS = 2
+# 1 = всегда качать весь период заново (без продолжения с последней stat_date)
+FULL_RELOAD = os.getenv("ETL_PERF_DAILY_FULL_RELOAD", "0") == "1"
 
-def run(date_from_str: str, date_to_str: str):
+def run(date_from_str: str, date_to_str: str, full: bool = FULL_RELOAD):
     date_from = datetime.strptime(date_from_str, "%Y-%m-%d").date()
     date_to   = datetime.strptime(date_to_str, "%Y-%m-%d").date()
 
     cur_from = date_from
+    if not full:
+        # история уже в базе: продолжаем с последнего загруженного дня (минус перекрытие),
+        # а не перекачиваем весь период каждый запуск.
+        # Только если загруженное покрывает начало периода: иначе это бэкфилл
+        # (в базе, скажем, ноябрь–декабрь, а просят январь–декабрь) — качаем с date_from.
+        row = fetch_one(
+            "SELECT min(stat_date), max(stat_date) FROM performance_campaign_daily WHERE stat_date <= %s;",
+            (date_to,),
+        )
+        existing_min, existing_max = (row[0], row[1]) if row else (None, None)
+        if existing_max is not None and existing_min <= date_from:
+            cur_from = max(date_from, existing_max - timedelta(days=RESUME_OVERLAP_DAYS))
+            if cur_from > date_from:
+                print(f"[performance_daily] resume from {cur_from} (loaded up to {existing_max})")
+        elif existing_min is not None:
+            print(f"[performance_daily] backfill from {date_from} (loaded only from {existing_min})")
     total = 0
 
     while cur_from <= date_to:
@@ -104,6 +126,7 @@ def run(date_from_str: str, date_to_str: str):
 
 if __name__ == "__main__":
     import sys
-    if len(sys.argv) != 3:
-        raise SystemExit("Usage: python -m src.performance_daily_etl YYYY-MM-DD YYYY-MM-DD")
-    run(sys.argv[1], sys.argv[2])
\ No newline at end of file
+    args = [a for a in sys.argv[1:] if a != "--full"]
+    if len(args) != 2:
+        raise SystemExit("Usage: python -m src.performance_daily_etl YYYY-MM-DD YYYY-MM-DD [--full]")
+    run(args[0], args[1], full=FULL_RELOAD or "--full" in sys.argv[1:])
\ No newline at end of file
@@ -1,31 +1,44 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, date
 from decimal import Decimal
+from functools import lru_cache
 import time
 import random
-import requests
+from psycopg2.extras import execute_values
 
-from src.core.config import settings
-from src.core.db import execute_query
-from src.core.db import fetch_one
+from src.core.db import execute_query, transaction
+from src.core.db import fetch_all, fetch_one
+from src.core.http import SESSION, json_loads
+from src.ozon.performance_api import get_perf_token as get_token
 
 BASE_URL = "https://api-performance.ozon.ru"
 
-def parse_date_any(s: str | None):
-    """Парсим даты из Performance API: '05.12.2025' или '2025-12-05'."""
-    if not s:
+# сколько 60-дневных окон отчёта генерируем/ждём одновременно
+WINDOW_WORKERS = 4
+
+def _slice_date(s: str) -> date | None:
+    """
+    '2025-12-05' / '05.12.2025' / '05/12/2025' срезами строки, без strptime
+    (он медленный: locale + regex, и на каждый неподошедший формат — исключение).
+    None — если строка не такого вида, тогда идём в общий путь.
+    """
+    if len(s) != 10:
         return None
-    s = str(s).strip()
-    for fmt in ("%Y-%m-%d", "%d.%m.%Y"):
-        try:
-            return datetime.strptime(s, fmt).date()
-        except ValueError:
-            pass
-    raise ValueError(f"Unknown date format: {s}")
+    try:
+        if s[4] == "-" and s[7] == "-":
+            return date(int(s[:4]), int(s[5:7]), int(s[8:10]))
+        if s[2] in "./" and s[5] == s[2]:
+            return date(int(s[6:]), int(s[3:5]), int(s[:2]))
+    except ValueError:
+        return None
+    return None
 
+@lru_cache(maxsize=4096, typed=True)
 def dec_ru(x) -> Decimal:
     """Парсим деньги вида '1811,00' -> Decimal('1811.00')"""
+    # ставки, цены и bid_percent в отчёте сильно повторяются, Decimal неизменяемый — кэшируем
     if x is None:
         return Decimal("0")
     s = str(x).strip().replace(" ", "").replace("\u00a0", "")
@@ -33,10 +46,42 @@ def dec_ru(x) -> Decimal:
         return Decimal("0")
     return Decimal(s.replace(",", "."))
 
-def resolve_posting_order_id(order_number: str | None) -> tuple[str | None, str | None]:
+def _raw_order_number(r: dict):
+    # В Performance "orderNumber" = корень posting_number (например '47533921-0235')
+    return r.get("orderNumber") or r.get("orderNumberId") or r.get("order_id") or r.get("orderId")
+
+def preload_posting_order_ids(order_numbers) -> dict[str, str]:
+    """
+    Одним запросом находим posting_number для всех order_number отчёта:
+    {'47533921-0235': '47533921-0235-1', ...} (берём самый свежий, как и resolve_posting_order_id).
+    """
+    cands = sorted({str(x).strip() for x in order_numbers if x})
+    if not cands:
+        return {}
+
+    rows = fetch_all(
+        """
+        SELECT DISTINCT ON (c.cand) c.cand, o.order_id
+        FROM unnest(%s::text[]) AS c(cand)
+        -- префикс диапазоном — под idx_orders_order_id_prefix (text_pattern_ops)
+        JOIN orders o
+          ON o.order_id ~>=~ (c.cand || '-')
+         AND o.order_id ~<~ (c.cand || '.')
+         AND o.order_id LIKE c.cand || '-%%'
+        ORDER BY c.cand, o.order_date DESC;
+        """,
+        (cands,)
+    )
+    return {r["cand"]: r["order_id"] for r in rows}
+
+def resolve_posting_order_id(
+    order_number: str | None,
+    known: dict[str, str] | None = None,
+) -> tuple[str | None, str | None]:
     """
     order_number из Performance: '47533921-0235'
     В orders лежит posting_number: '47533921-0235-1'
+    known — результат preload_posting_order_ids: тогда без запроса в БД.
     Возвращаем:
       (order_id_to_save, ext_order_id)
     """
@@ -45,6 +90,9 @@ def resolve_posting_order_id(order_number: str | None) -> tuple[str | None, str
 
     cand = str(order_number).strip()
 
+    if known is not None:
+        return known.get(cand), cand
+
     row = fetch_one(
         "SELECT order_id FROM orders WHERE order_id LIKE %s ORDER BY order_date DESC LIMIT 1;",
         (cand + "-%",)
@@ -64,6 +112,10 @@ def _parse_date(x) -> date | None:
         return None
     s = str(x).strip()
 
+    d = _slice_date(s[:10]) if s[10:11] in ("", "T", " ") else None
+    if d:
+        return d
+
     for fmt in ("%Y-%m-%d", "%d.%m.%Y", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%SZ"):
         try:
             return datetime.strptime(s, fmt).date()
@@ -76,10 +128,16 @@ def _parse_date(x) -> date | None:
     except Exception:
         return None
 
+@lru_cache(maxsize=4096)
 def parse_date_any(s: str | None):
+    """Парсим даты из Performance API: '05.12.2025', '2025-12-05' или '05/12/2025'."""
+    # в отчёте несколько десятков разных дат на тысячи строк — отсюда кэш
     if not s:
         return None
     s = str(s).strip()
+    d = _slice_date(s)
+    if d:
+        return d
     for fmt in ("%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y"):
         try:
             return datetime.strptime(s, fmt).date()
@@ -95,9 +153,9 @@ def _post_json(path: str, payload: dict, token: str) -> dict:
     base_sleep = 1.2
 
     for attempt in range(max_retries):
-        r = requests.post(url, json=payload, headers=headers, timeout=90)
+        r = SESSION.post(url, json=payload, headers=headers, timeout=90)
         if r.ok:
-            return r.json()
+            return json_loads(r.content)
         if r.status_code in (500, 502, 503, 504):
             sleep = base_sleep * (2 ** attempt) + random.uniform(0, 0.5)
             print(f"[perf] {r.status_code} on {path}, retry in {sleep:.1f}s...")
@@ -110,25 +168,15 @@ def _post_json(path: str, payload: dict, token: str) -> dict:
 def _get(path: str, token: str) -> dict | str:
     url = f"{BASE_URL}{path}"
     headers = {"Authorization": f"Bearer {token}"}
-    r = requests.get(url, headers=headers, timeout=90)
+    r = SESSION.get(url, headers=headers, timeout=90)
     if not r.ok:
         raise RuntimeError(f"Performance API error {r.status_code}: {r.text}")
     # report может быть CSV/JSON — оставим как текст, если не JSON
     ct = (r.headers.get("Content-Type") or "").lower()
     if "application/json" in ct:
-        return r.json()
+        return json_loads(r.content)
     return r.text
 
-def get_token() -> str:
-    payload = {
-        "client_id": settings.OZON_PERF_CLIENT_ID,
-        "client_secret": settings.OZON_PERF_CLIENT_SECRET,
-        "grant_type": "client_credentials",
-    }
-    data = requests.post(f"{BASE_URL}/api/client/token", json=payload, timeout=60)
-    data.raise_for_status()
-    return data.json()["access_token"]
-
 def order_exists(order_id: str) -> bool:
     return fetch_one("SELECT 1 FROM orders WHERE order_id=%s LIMIT 1;", (order_id,)) is not None
 
@@ -164,6 +212,10 @@ def generate_orders_report(date_from: date, date_to: date, token: str) -> str:
 
 def wait_report(uuid: str, token: str, max_wait_sec: int = 180) -> str:
     started = time.time()
+    # быстрые отчёты готовы почти сразу: начинаем с 0.2s и растём до 5s (+ jitter)
+    base_sleep = 0.2
+    max_sleep = 5.0
+    attempt = 0
     while True:
         st = _get(f"/api/client/statistics/{uuid}", token)
         state = st.get("state")
@@ -173,7 +225,8 @@ def wait_report(uuid: str, token: str, max_wait_sec: int = 180) -> str:
             raise RuntimeError(f"[perf] report {uuid} failed: {st}")
         if time.time() - started > max_wait_sec:
             raise RuntimeError(f"[perf] report {uuid} timeout, last state={state}")
-        time.sleep(1.5)
+        time.sleep(min(max_sleep, base_sleep * (2 ** attempt)) + random.uniform(0, 0.2))
+        attempt += 1
 
 def fetch_report_json(uuid: str, token: str) -> dict:
     # чаще всего: /api/client/statistics/report?UUID=...
@@ -196,17 +249,22 @@ def load_report_rows(rows: list[dict]) -> int:
         spent, bid, bid_percent, qty,
         source
       )
-      VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,'performance_api')
+      VALUES %s
       ON CONFLICT DO NOTHING;
     """
+    insert_template = "(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,'performance_api')"
 
-    n = 0
+    # один запрос на весь отчёт вместо LIKE-поиска на каждую строку
+    known_orders = preload_posting_order_ids(_raw_order_number(r) for r in rows)
+
+    values = []
     for r in rows:
-        # В orders-report может НЕ быть campaignId — тогда кладём в '0' = UNKNOWN,
+        # В orders-report может НЕ быть campaignId — тогда кладём 0 = UNKNOWN,
         # чтобы пройти NOT NULL в таблице performance_order_attribution.
-        campaign_id = str(
-            r.get("campaignId") or r.get("campaign_id") or r.get("id") or "0"
-        ).strip() or "0"
+        try:
+            campaign_id = int(r.get("campaignId") or r.get("campaign_id") or r.get("id") or 0)
+        except (TypeError, ValueError):
+            campaign_id = 0
 
         campaign_title = (
             r.get("campaignTitle")
@@ -218,9 +276,7 @@ def load_report_rows(rows: list[dict]) -> int:
 
         stat_date = parse_date_any(r.get("date"))
 
-        # В Performance "orderNumber" = корень posting_number (например '47533921-0235')
-        raw_order = r.get("orderNumber") or r.get("orderNumberId") or r.get("order_id") or r.get("orderId")
-        order_id, ext_order_id = resolve_posting_order_id(raw_order)
+        order_id, ext_order_id = resolve_posting_order_id(_raw_order_number(r), known_orders)
 
         sku = r.get("sku") or r.get("skuId")
         try:
@@ -250,7 +306,7 @@ def load_report_rows(rows: list[dict]) -> int:
         else:
           unmatched += 1
 
-        execute_query(insert_q, (
+        values.append((
             campaign_id, campaign_title,
             order_id, ext_order_id,
             sku, offer_id, product_name,
@@ -258,10 +314,14 @@ def load_report_rows(rows: list[dict]) -> int:
             price, amount,
             spent, bid, bid_percent, qty,
         ))
-        n += 1
+
+    # весь отчёт — пачками по 1000 строк в одной транзакции (без ожидания fsync: данные из API)
+    if values:
+        with transaction(synchronous_commit=False) as cur:
+            execute_values(cur, insert_q, values, template=insert_template, page_size=1000)
 
     print(f"[perf_orders] matched to orders: {matched}, unmatched: {unmatched}")
-    return n
+    return len(values)
 
 def apply_to_orders(date_from: date, date_to: date):
     # 1) проставим campaign_id/title в orders (если по заказу есть единственная кампания — берём max)
@@ -297,6 +357,19 @@ def apply_to_orders(date_from: date, date_to: date):
       WHERE o.order_id = x.order_id;
     """, (date_from, date_to))
 
+def _fetch_window(cur_from: date, cur_to: date, token: str) -> list[dict]:
+    """generate → wait → fetch одного окна; только HTTP, без записи в БД."""
+    print(f"[perf_orders] window {cur_from}..{cur_to}")
+
+    uuid = generate_orders_report(cur_from, cur_to, token)
+    link = wait_report(uuid, token)
+
+    # если link вернул /api/client/statistics/report?UUID=...
+    # вытащим UUID оттуда просто берём uuid
+    rep = fetch_report_json(uuid, token)
+
+    return rep.get("rows") or rep.get("list") or []
+
 def run(date_from_str: str, date_to_str: str):
     date_from = datetime.strptime(date_from_str, "%Y-%m-%d").date()
     date_to   = datetime.strptime(date_to_str, "%Y-%m-%d").date()
@@ -305,26 +378,22 @@ def run(date_from_str: str, date_to_str: str):
 
     # ограничение окна — да, часто ~62 дня. Поэтому режем.
     window_days = 60
+    windows = []
     cur_from = date_from
-    total = 0
-
     while cur_from <= date_to:
         cur_to = min(cur_from + timedelta(days=window_days-1), date_to)
-        print(f"[perf_orders] window {cur_from}..{cur_to}")
-
-        uuid = generate_orders_report(cur_from, cur_to, token)
-        link = wait_report(uuid, token)
+        windows.append((cur_from, cur_to))
+        cur_from = cur_to + timedelta(days=1)
 
-        # если link вернул /api/client/statistics/report?UUID=...
-        # вытащим UUID оттуда просто берём uuid
-        rep = fetch_report_json(uuid, token)
+    total = 0
 
-        rows = rep.get("rows") or rep.get("list") or []
-        n = load_report_rows(rows)
-        total += n
+    # окна почти всё время ждут wait_report — качаем их параллельно,
+    # а пишем в БД по одному окну (map отдаёт результаты в порядке окон)
+    with ThreadPoolExecutor(max_workers=min(WINDOW_WORKERS, len(windows) or 1)) as pool:
+        for rows in pool.map(lambda w: _fetch_window(w[0], w[1], token), windows):
+            n = load_report_rows(rows)
+            total += n
 
-        cur_from = cur_to + timedelta(days=1)
-    
     # print(rows[0])
     print(f"[perf_orders] rows inserted: {total}")
     apply_to_orders(date_from, date_to)
@@ -9,7 +9,93 @@ ALTER TABLE ... ADD COLUMN IF NOT EXISTS.
 
 from __future__ import annotations
 
-from src.core.db import execute_query
+import re
+import time
+from typing import List, Optional, Tuple
+
+from src.core import db
+
+# Пока идёт run(), DDL не уходит в базу по одному запросу: create_* только
+# складывают его сюда, а run() отправляет всё одним execute в одной транзакции.
+_pending: Optional[List[str]] = None
+# CREATE INDEX внутри run() откладываются сюда и строятся после транзакции
+# с CONCURRENTLY — без блокировки записи в уже заполненные таблицы.
+_pending_indexes: Optional[List[str]] = None
+
+# пауза между сборками индексов (сек)
+INDEX_BUILD_PAUSE_SEC = 0.2
+
+_CREATE_INDEX_RE = re.compile(r"^\s*CREATE\s+(UNIQUE\s+)?INDEX\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.IGNORECASE)
+
+
+def execute_query(query: str, params: tuple | None = None) -> None:
+    """db.execute_query, но внутри run() — отложенно, в общую пачку DDL."""
+    if _pending is not None and params is None:
+        if _CREATE_INDEX_RE.match(query):
+            _pending_indexes.append(query.strip().rstrip(";"))
+        else:
+            _pending.append(query.strip().rstrip(";"))
+        return
+    db.execute_query(query, params)
+
+
+def _create_index_concurrently(cur, query: str) -> bool:
+    """
+    CREATE INDEX ... → CREATE INDEX CONCURRENTLY ... (cur — autocommit, вне транзакции).
+    Уже существующий валидный индекс пропускаем без запроса на создание.
+    Если прошлый CONCURRENTLY упал, остаётся невалидный индекс, который
+    IF NOT EXISTS молча пропустил бы, — такой сначала удаляем.
+    Возвращает True, если индекс действительно строился.
+    """
+    m = _CREATE_INDEX_RE.match(query)
+    name = m.group(2)
+
+    cur.execute(
+        """
+        SELECT i.indisvalid
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s;
+        """,
+        (name,),
+    )
+    row = cur.fetchone()
+    if row is not None:
+        if row[0]:
+            return False
+        print(f"[migrations] drop invalid index {name}")
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+
+    cur.execute(
+        f"CREATE {m.group(1) or ''}INDEX CONCURRENTLY IF NOT EXISTS {name}" + query[m.end():]
+    )
+    return True
+
+
+def _set_lz4_compression(table: str, column: str) -> None:
+    """
+    TOAST-сжатие lz4 для большой JSONB-колонки: быстрее pglz и на записи, и на чтении.
+    Только PostgreSQL 14+ и сборка с lz4 — иначе молча остаёмся на pglz.
+    Новое сжатие применяется к новым версиям строк (старые — после перезаписи / VACUUM FULL).
+    """
+    execute_query(
+        f"""
+        DO $$
+        BEGIN
+          IF current_setting('server_version_num')::int >= 140000 THEN
+            IF (
+              SELECT attcompression FROM pg_attribute
+              WHERE attrelid = '{table}'::regclass AND attname = '{column}'
+            ) IS DISTINCT FROM 'l' THEN
+              -- через EXECUTE: на старых версиях plpgsql не разберёт SET COMPRESSION
+              EXECUTE 'ALTER TABLE {table} ALTER COLUMN {column} SET COMPRESSION lz4';
+            END IF;
+          END IF;
+        EXCEPTION WHEN feature_not_supported THEN
+          RAISE NOTICE 'lz4 is not supported by this server, keeping pglz for {table}.{column}';
+        END $$;
+        """
+    )
 
 
 # -----------------------------
@@ -49,8 +135,35 @@ def create_orders_table() -> None:
     )
 
     # Базовые индексы для фильтраций/джойнов
-    execute_query("CREATE INDEX IF NOT EXISTS idx_orders_order_date ON orders(order_date);")
-    execute_query("CREATE INDEX IF NOT EXISTS idx_orders_customer_id ON orders(customer_id);")
+    # (по order_date отдельно не нужен: его покрывает idx_orders_date_status, см. create_orders_indexes)
+    execute_query("DROP INDEX IF EXISTS idx_orders_order_date;")
+    # (customer_id, order_date): пересчёт агрегатов клиентов и is_first_order
+    # (GROUP BY / окно по клиенту с сортировкой по дате); заменяет индекс только по customer_id
+    execute_query("CREATE INDEX IF NOT EXISTS idx_orders_customer_date ON orders(customer_id, order_date);")
+    execute_query("DROP INDEX IF EXISTS idx_orders_customer_id;")
+
+    # Привязка "<order_number>-*" → posting_number (finance_api, performance):
+    # text_pattern_ops сравнивает побайтово, поэтому диапазон по префиксу идёт
+    # по индексу при любой collation (обычный PK-индекс тут не помогает).
+    execute_query("CREATE INDEX IF NOT EXISTS idx_orders_order_id_prefix ON orders (order_id text_pattern_ops);")
+
+    # Покрывающие индексы под метрики дашборда (фильтр по дате/кампании/первому заказу,
+    # агрегаты по customer_id/revenue) — Postgres может отвечать Index Only Scan.
+    execute_query(
+        """
+        CREATE INDEX IF NOT EXISTS idx_orders_metrics
+        ON orders(order_date, campaign, is_first_order)
+        INCLUDE (order_id, customer_id, revenue);
+        """
+    )
+    execute_query(
+        """
+        CREATE INDEX IF NOT EXISTS idx_orders_first
+        ON orders(order_date)
+        INCLUDE (customer_id, revenue)
+        WHERE is_first_order;
+        """
+    )
 
     # "догоняем" обязательные колонки, которые появились позже в ETL/дашбордах
     execute_query(
@@ -65,7 +178,7 @@ def create_orders_table() -> None:
           ADD COLUMN IF NOT EXISTS ozon_acquiring_fee NUMERIC,
           ADD COLUMN IF NOT EXISTS ozon_ads_fee NUMERIC,
 
-          ADD COLUMN IF NOT EXISTS campaign_id TEXT,
+          ADD COLUMN IF NOT EXISTS campaign_id BIGINT,
           ADD COLUMN IF NOT EXISTS campaign_title TEXT,
           ADD COLUMN IF NOT EXISTS ozon_ads_attributed NUMERIC,
 
@@ -78,6 +191,22 @@ def create_orders_table() -> None:
           ADD COLUMN IF NOT EXISTS ozon_missing_at TIMESTAMP;
         """
     )
+    # campaign_id — тот же BIGINT, что в рекламных таблицах (идёт из performance_order_attribution)
+    _campaign_id_to_bigint("orders")
+
+
+def create_orders_indexes() -> None:
+    """
+    Индексы под горячие фильтры ETL и дашбордов по orders.
+    Идут после ALTER TABLE orders (status, campaign_id, ozon_missing появились позже)
+    и, как все индексы, строятся CONCURRENTLY / откладываются до первой загрузки.
+    """
+    # окно по дате + статус; ведущая order_date заменяет одиночный индекс по дате
+    execute_query("CREATE INDEX IF NOT EXISTS idx_orders_date_status ON orders(order_date, status);")
+    # «живые» заказы (не пропавшие из API) — частичный индекс меньше полного
+    execute_query("CREATE INDEX IF NOT EXISTS idx_orders_active ON orders(order_date) WHERE ozon_missing = false;")
+    # джойны с рекламой по кампании (BIGINT, как performance_* / perf_campaigns — без приведения типов)
+    execute_query("CREATE INDEX IF NOT EXISTS idx_orders_campaign_id ON orders(campaign_id);")
 
 
 def create_products_table() -> None:
@@ -92,6 +221,9 @@ def create_products_table() -> None:
         """
     )
 
+    # для EXISTS-фильтров по вкусу/граммовке: вкус и граммовка читаются прямо из индекса
+    execute_query("CREATE INDEX IF NOT EXISTS idx_products_sku_attrs ON products(sku) INCLUDE (flavor, grams);")
+
 
 def create_order_items_table() -> None:
     execute_query(
@@ -107,8 +239,10 @@ def create_order_items_table() -> None:
         """
     )
 
-    execute_query("CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items(order_id);")
     execute_query("CREATE INDEX IF NOT EXISTS idx_order_items_sku ON order_items(sku);")
+    # (order_id, sku): EXISTS-фильтры дашборда по товарам заказа; заменяет индекс только по order_id
+    execute_query("CREATE INDEX IF NOT EXISTS idx_order_items_order_sku ON order_items(order_id, sku);")
+    execute_query("DROP INDEX IF EXISTS idx_order_items_order_id;")
 
 
 def create_order_fee_items_table() -> None:
@@ -127,7 +261,14 @@ def create_order_fee_items_table() -> None:
         """
     )
 
-    execute_query("CREATE INDEX IF NOT EXISTS idx_order_fee_items_order_id ON order_fee_items(order_id);")
+    # покрывающий индекс для recalc_orders_finance: агрегаты по заказу читаются из индекса
+    execute_query(
+        """
+        CREATE INDEX IF NOT EXISTS idx_order_fee_items_order_cover
+        ON order_fee_items(order_id) INCLUDE (fee_group, amount, source);
+        """
+    )
+    execute_query("DROP INDEX IF EXISTS idx_order_fee_items_order_id;")
     execute_query("CREATE INDEX IF NOT EXISTS idx_order_fee_items_group_name ON order_fee_items(fee_group, fee_name);")
 
     # uid для идемпотентного UPSERT (finance_api)
@@ -138,8 +279,39 @@ def create_order_fee_items_table() -> None:
         """
     )
 
-    # обычный UNIQUE (без WHERE), чтобы ON CONFLICT(uid) работал
-    execute_query("DROP INDEX IF EXISTS ux_order_fee_items_uid;")
+    # колонки строк finance_api / отчёта начислений
+    execute_query(
+        """
+        ALTER TABLE order_fee_items
+          ADD COLUMN IF NOT EXISTS ext_order_id TEXT,
+          ADD COLUMN IF NOT EXISTS operation_type TEXT,
+          ADD COLUMN IF NOT EXISTS occurred_at TIMESTAMP,
+          ADD COLUMN IF NOT EXISTS sku BIGINT;
+        """
+    )
+
+    # выборки/удаления по источнику: DELETE ... WHERE source = ...,
+    # finance_period_costs (source='finance_api' за период по occurred_at)
+    execute_query(
+        "CREATE INDEX IF NOT EXISTS idx_order_fee_items_source_occurred ON order_fee_items(source, occurred_at);"
+    )
+
+    # обычный UNIQUE (без WHERE), чтобы ON CONFLICT(uid) работал.
+    # Старый частичный индекс с тем же именем удаляем (один раз), а не пересоздаём
+    # индекс при каждом запуске: пока его нет, upsert по uid падает.
+    execute_query(
+        """
+        DO $$
+        BEGIN
+          IF EXISTS (
+            SELECT 1 FROM pg_indexes
+            WHERE indexname = 'ux_order_fee_items_uid' AND indexdef LIKE '% WHERE %'
+          ) THEN
+            DROP INDEX ux_order_fee_items_uid;
+          END IF;
+        END $$;
+        """
+    )
     execute_query(
         """
         CREATE UNIQUE INDEX IF NOT EXISTS ux_order_fee_items_uid
@@ -187,13 +359,58 @@ def create_perf_campaigns_table() -> None:
         );
         """
     )
+    _set_lz4_compression("perf_campaigns", "raw")
+
+
+def _campaign_id_to_bigint(table: str) -> None:
+    """
+    campaign_id раньше был TEXT; теперь BIGINT, как perf_campaigns.campaign_id:
+    джойны orders / рекламных таблиц / каталога кампаний по целому ключу.
+    Переводим один раз — если колонка ещё text.
+
+    Переводим, только если все значения — канонические числа ('7', но не '007' / ' 7' / 'abc'):
+    тогда перевод взаимно однозначен и не ломает PK (campaign_id, stat_date).
+    Иначе колонку оставляем TEXT и пишем WARNING с примерами плохих значений —
+    миграция (одна транзакция на весь DDL) не падает, данные не теряются;
+    после чистки значений перевод выполнится на следующем прогоне.
+    """
+    execute_query(
+        f"""
+        DO $$
+        DECLARE
+          bad_rows bigint;
+          bad_sample text;
+        BEGIN
+          IF EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = '{table}'
+              AND column_name = 'campaign_id' AND data_type = 'text'
+          ) THEN
+            SELECT count(*), string_agg(DISTINCT quote_literal(campaign_id), ', ')
+            INTO bad_rows, bad_sample
+            FROM (
+              SELECT campaign_id FROM {table}
+              WHERE campaign_id IS NOT NULL
+                AND campaign_id !~ '^(0|[1-9][0-9]{{0,17}})$'
+              LIMIT 20
+            ) bad;
+
+            IF bad_rows > 0 THEN
+              RAISE WARNING '{table}.campaign_id остаётся TEXT: нечисловые/неканонические значения, например: %', bad_sample;
+            ELSE
+              ALTER TABLE {table} ALTER COLUMN campaign_id TYPE BIGINT USING campaign_id::bigint;
+            END IF;
+          END IF;
+        END $$;
+        """
+    )
 
 
 def create_performance_campaign_daily_table() -> None:
     execute_query(
         """
         CREATE TABLE IF NOT EXISTS performance_campaign_daily (
-          campaign_id    TEXT NOT NULL,
+          campaign_id    BIGINT NOT NULL,
           campaign_title TEXT,
           stat_date      DATE NOT NULL,
 
@@ -209,6 +426,8 @@ def create_performance_campaign_daily_table() -> None:
         """
     )
 
+    _campaign_id_to_bigint("performance_campaign_daily")
+
     execute_query("CREATE INDEX IF NOT EXISTS idx_pcd_stat_date ON performance_campaign_daily(stat_date);")
     execute_query("CREATE INDEX IF NOT EXISTS idx_pcd_campaign_id ON performance_campaign_daily(campaign_id);")
 
@@ -218,7 +437,7 @@ def create_performance_order_attribution_table() -> None:
         """
         CREATE TABLE IF NOT EXISTS performance_order_attribution (
           id BIGSERIAL PRIMARY KEY,
-          campaign_id TEXT,
+          campaign_id BIGINT,
           campaign_title TEXT,
           order_id TEXT,
           ext_order_id TEXT,
@@ -236,66 +455,206 @@ def create_performance_order_attribution_table() -> None:
         """
     )
 
+    _campaign_id_to_bigint("performance_order_attribution")
+
     execute_query("CREATE INDEX IF NOT EXISTS idx_poa_order_id ON performance_order_attribution(order_id);")
     execute_query("CREATE INDEX IF NOT EXISTS idx_poa_stat_date ON performance_order_attribution(stat_date);")
     execute_query("CREATE INDEX IF NOT EXISTS idx_poa_campaign_date ON performance_order_attribution(campaign_id, stat_date);")
 
 
-def create_finance_period_costs_table() -> None:
+def create_finance_period_costs_view() -> None:
     """
-    Для отчётов/дашбордов: периодные расходы по дням/группам/статьям.
+    Для отчётов/дашбордов: периодные расходы по дням/группам/статьям
+    (строки finance_api без заказа). Материализованное представление с тем же
+    именем и колонками, что была таблица, — дашборды не меняются.
+    Обновляется в update_all (REFRESH ... CONCURRENTLY, нужен уникальный индекс).
     """
+    # раньше это была таблица, которую ETL чистил и наполнял по окну;
+    # данные производные — таблицу просто заменяем представлением (один раз)
+    execute_query(
+        """
+        DO $$
+        BEGIN
+          IF EXISTS (
+            SELECT 1 FROM pg_class
+            WHERE relname = 'finance_period_costs' AND relkind = 'r'
+              AND relnamespace = 'public'::regnamespace
+          ) THEN
+            DROP TABLE finance_period_costs;
+          END IF;
+        END $$;
+        """
+    )
     execute_query(
         """
-        CREATE TABLE IF NOT EXISTS finance_period_costs (
-          cost_date DATE NOT NULL,
-          fee_group TEXT NOT NULL,
-          fee_name  TEXT NOT NULL,
-          amount    NUMERIC NOT NULL DEFAULT 0,
-          PRIMARY KEY (cost_date, fee_group, fee_name)
+        CREATE MATERIALIZED VIEW IF NOT EXISTS finance_period_costs AS
+        SELECT
+            DATE(occurred_at) AS cost_date,
+            fee_group,
+            fee_name,
+            SUM(amount)       AS amount
+        FROM order_fee_items
+        WHERE source = 'finance_api'
+          AND order_id IS NULL
+          AND occurred_at IS NOT NULL
+        GROUP BY 1, 2, 3;
+        """
+    )
+
+    # ведущая cost_date — заодно индекс для фильтра по дате
+    execute_query(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_finance_period_costs ON finance_period_costs(cost_date, fee_group, fee_name);"
+    )
+
+
+def create_postings_raw_table() -> None:
+    """
+    Сырые postings из Seller API: по ним ETL понимает, какие заказы изменились
+    с прошлого запуска, и разбирает только их.
+    """
+    execute_query(
+        """
+        CREATE TABLE IF NOT EXISTS postings_raw (
+            posting_number TEXT PRIMARY KEY,
+            payload JSONB NOT NULL,
+            fetched_at TIMESTAMPTZ NOT NULL DEFAULT now()
         );
         """
     )
+    _set_lz4_compression("postings_raw", "payload")
 
-    execute_query("CREATE INDEX IF NOT EXISTS idx_finance_period_costs_date ON finance_period_costs(cost_date);")
+
+# -----------------------------
+# Reporting views
+# -----------------------------
+
+def create_customer_cohort_month_view() -> None:
+    """
+    Когорты по месяцу первого заказа: агрегат по customers считаем один раз за ETL,
+    а дашборд читает готовые строки.
+    Обновляется в конце update_all (REFRESH ... CONCURRENTLY, нужен уникальный индекс).
+    """
+    execute_query(
+        """
+        CREATE MATERIALIZED VIEW IF NOT EXISTS customer_cohort_month AS
+        SELECT
+            DATE_TRUNC('month', first_order_date)::date AS cohort_month,
+            COUNT(*)           AS customers_count,
+            SUM(total_revenue) AS cohort_revenue,
+            AVG(total_revenue) AS avg_revenue_per_customer
+        FROM customers
+        WHERE first_order_date IS NOT NULL
+        GROUP BY 1;
+        """
+    )
+
+    execute_query("CREATE UNIQUE INDEX IF NOT EXISTS ux_customer_cohort_month ON customer_cohort_month(cohort_month);")
 
 
 # -----------------------------
 # Runner
 # -----------------------------
 
-def run() -> None:
-    print("[migrations] customers...")
+def _collect_statements(verbose: bool = True) -> Tuple[List[str], List[str]]:
+    """Прогоняет create_* в режиме сбора: (DDL таблиц, CREATE INDEX)."""
+    global _pending, _pending_indexes
+    _pending, _pending_indexes = [], []
+    try:
+        _collect(verbose)
+        return _pending, _pending_indexes
+    finally:
+        _pending, _pending_indexes = None, None
+
+
+def _is_unique(query: str) -> bool:
+    return bool(_CREATE_INDEX_RE.match(query).group(1))
+
+
+def needs_bootstrap() -> bool:
+    """Схемы ещё нет (первый запуск на пустой базе)."""
+    row = db.fetch_one("SELECT to_regclass('public.orders') IS NULL AS empty;")
+    return bool(row["empty"])
+
+
+def run(with_indexes: bool = True) -> None:
+    """
+    with_indexes=False — только таблицы и UNIQUE-индексы (на них опираются
+    ON CONFLICT и REFRESH ... CONCURRENTLY). Остальные индексы строит
+    create_indexes() после первой массовой загрузки: так вставки не
+    обновляют каждый индекс на каждой строке.
+    """
+    statements, indexes = _collect_statements()
+
+    # Весь DDL — один round-trip и одна транзакция: упадёт что-то — не применится ничего.
+    print(f"[migrations] apply {len(statements)} statements...")
+    with db.transaction() as cur:
+        cur.execute(";\n".join(statements) + ";")
+
+    if not with_indexes:
+        indexes = [q for q in indexes if _is_unique(q)]
+        print("[migrations] non-unique indexes deferred (create_indexes)")
+
+    _build_indexes(indexes)
+    print("[migrations] OK ✅")
+
+
+def create_indexes() -> None:
+    """Строит все индексы схемы (уже существующие пропускаются)."""
+    _, indexes = _collect_statements(verbose=False)
+    _build_indexes(indexes)
+    print("[migrations] indexes OK ✅")
+
+
+def _build_indexes(indexes: List[str]) -> None:
+    # Индексы — по одному, CONCURRENTLY (в транзакции так нельзя), на своём
+    # соединении вне пула: долгие сборки не отбирают соединения у ETL.
+    # После каждой реальной сборки — короткая пауза, чтобы не грузить базу подряд.
+    print(f"[migrations] indexes ({len(indexes)}, concurrently)...")
+    with db.autocommit_cursor() as cur:
+        for query in indexes:
+            if _create_index_concurrently(cur, query):
+                time.sleep(INDEX_BUILD_PAUSE_SEC)
+
+
+def _collect(verbose: bool = True) -> None:
+    log = print if verbose else (lambda *_: None)
+
+    log("[migrations] customers...")
     create_customers_table()
 
-    print("[migrations] orders...")
+    log("[migrations] orders...")
     create_orders_table()
+    create_orders_indexes()
 
-    print("[migrations] products...")
+    log("[migrations] products...")
     create_products_table()
 
-    print("[migrations] order_items...")
+    log("[migrations] order_items...")
     create_order_items_table()
 
-    print("[migrations] order_fee_items...")
+    log("[migrations] order_fee_items...")
     create_order_fee_items_table()
 
-    print("[migrations] ads_campaigns...")
+    log("[migrations] ads_campaigns...")
     create_ads_campaigns_table()
 
-    print("[migrations] perf_campaigns...")
+    log("[migrations] perf_campaigns...")
     create_perf_campaigns_table()
 
-    print("[migrations] performance_campaign_daily...")
+    log("[migrations] performance_campaign_daily...")
     create_performance_campaign_daily_table()
 
-    print("[migrations] performance_order_attribution...")
+    log("[migrations] performance_order_attribution...")
     create_performance_order_attribution_table()
 
-    print("[migrations] finance_period_costs...")
-    create_finance_period_costs_table()
+    log("[migrations] finance_period_costs...")
+    create_finance_period_costs_view()
 
-    print("[migrations] OK ✅")
+    log("[migrations] postings_raw...")
+    create_postings_raw_table()
+
+    log("[migrations] customer_cohort_month...")
+    create_customer_cohort_month_view()
 
 
 if __name__ == "__main__":
@@ -1,22 +1,51 @@
-import requests
+import threading
+import time
+
 from src.core.config import settings
+from src.core.http import SESSION
+
+BASE = "https://api-performance.ozon.ru"
+
+# Токен Performance API живёт ~30 минут. Кэшируем его на процесс,
+# чтобы daily / campaigns / orders не делали POST /token на каждый шаг ETL.
+TOKEN_DEFAULT_TTL = 25 * 60   # если в ответе нет expires_in
+TOKEN_REFRESH_MARGIN = 60     # обновляем заранее, за минуту до истечения
+
+_token_lock = threading.Lock()
+_token_value: str | None = None
+_token_expires_at = 0.0
 
-BASE = "https://performance.ozon.ru"
 
-def get_perf_token() -> str:
+def _issue_perf_token() -> tuple[str, float]:
     url = f"{BASE}/api/client/token"
     payload = {
         "client_id": str(settings.OZON_PERF_CLIENT_ID),
         "client_secret": str(settings.OZON_PERF_CLIENT_SECRET),
         "grant_type": "client_credentials",
     }
-    r = requests.post(url, json=payload, timeout=60, headers={
+    r = SESSION.post(url, json=payload, timeout=60, headers={
         "Content-Type": "application/json",
         "Accept": "application/json",
     })
     r.raise_for_status()
     data = r.json()
-    return data["access_token"]
+    ttl = data.get("expires_in") or TOKEN_DEFAULT_TTL
+    return data["access_token"], time.monotonic() + float(ttl)
+
+
+def get_perf_token(force: bool = False) -> str:
+    """
+    Bearer-токен Performance API из кэша; новый выпускается,
+    только если до истечения текущего осталось меньше TOKEN_REFRESH_MARGIN.
+    Потокобезопасно: окна perf-отчётов берут токен из разных потоков.
+    """
+    global _token_value, _token_expires_at
+
+    with _token_lock:
+        if force or _token_value is None or time.monotonic() >= _token_expires_at - TOKEN_REFRESH_MARGIN:
+            _token_value, _token_expires_at = _issue_perf_token()
+        return _token_value
+
 
 if __name__ == "__main__":
     token = get_perf_token()
@@ -1,9 +1,10 @@
 # src/ozon_reports_api.py
 
+import random
 import time
-import requests
 
 from src.core.config import settings
+from src.core.http import SESSION
 
 BASE_URL = "https://api-seller.ozon.ru"
 
@@ -27,7 +28,7 @@ class OzonReportsClient:
             "date_to": date_to,
         }
 
-        r = requests.post(url, json=payload, headers=self.headers, timeout=30)
+        r = SESSION.post(url, json=payload, headers=self.headers, timeout=30)
         r.raise_for_status()
         return r.json()["result"]["report_code"]
 
@@ -37,9 +38,14 @@ class OzonReportsClient:
         """
         url = f"{BASE_URL}/v1/report/info"
         start = time.time()
+        # быстрые отчёты готовы за секунду-две: опрашиваем 1s → 2 → 4 → 8, не реже раза в 15s,
+        # с jitter, чтобы параллельные воркеры не били в API одновременно
+        base_sleep = 1.0
+        max_sleep = 15.0
+        attempt = 0
 
         while True:
-            r = requests.post(url, json={"code": report_code}, headers=self.headers, timeout=30)
+            r = SESSION.post(url, json={"code": report_code}, headers=self.headers, timeout=30)
             r.raise_for_status()
 
             result = r.json()["result"]
@@ -51,17 +57,24 @@ class OzonReportsClient:
             if status == "FAILED":
                 raise RuntimeError("Отчёт Ozon не сформировался")
 
-            if time.time() - start > timeout_sec:
+            elapsed = time.time() - start
+            if elapsed > timeout_sec:
                 raise TimeoutError("Таймаут ожидания отчёта Ozon")
 
-            time.sleep(5)
+            delay = min(max_sleep, base_sleep * (2 ** attempt)) * random.uniform(0.8, 1.2)
+            # не спим дольше оставшегося бюджета timeout_sec
+            time.sleep(max(0.0, min(delay, timeout_sec - elapsed)))
+            attempt += 1
 
     def download_file(self, file_url: str, path: str):
         """
         Скачиваем файл отчёта.
+        Потоково, кусками по 1 МБ: память не зависит от размера отчёта,
+        запись на диск идёт параллельно с загрузкой.
         """
-        r = requests.get(file_url, timeout=60)
-        r.raise_for_status()
+        with SESSION.get(file_url, timeout=(10, 300), stream=True) as r:
+            r.raise_for_status()
 
-        with open(path, "wb") as f:
-            f.write(r.content)
+            with open(path, "wb") as f:
+                for chunk in r.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
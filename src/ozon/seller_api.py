@@ -17,10 +17,13 @@
 """
 
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import Iterator, List, Dict, Any, Optional
 
 from src.core.config import settings
+from src.core.http import SESSION, json_loads
+
 
 class OzonSellerAPIError(Exception):
     """
@@ -43,16 +46,21 @@ class OzonSellerClient:
 
     BASE_URL = "https://api-seller.ozon.ru"
 
-    def __init__(self, client_id: str, api_key: str):
+    # Сколько страниц списка запрашиваем одновременно (1 = строго последовательно)
+    PAGE_CONCURRENCY = 4
+
+    def __init__(self, client_id: str, api_key: str, page_concurrency: Optional[int] = None):
         """
         Инициализация клиента.
 
         Параметры:
         - client_id: значение из кабинета Ozon (Client-Id)
         - api_key: значение API-ключа
+        - page_concurrency: сколько страниц тянуть параллельно (по умолчанию PAGE_CONCURRENCY)
         """
         self.client_id = client_id
         self.api_key = api_key
+        self.page_concurrency = max(1, page_concurrency or self.PAGE_CONCURRENCY)
 
         # Заголовки, которые будут отправляться в каждом запросе.
         # Ozon ожидает:
@@ -65,6 +73,11 @@ class OzonSellerClient:
             "Content-Type": "application/json"
         }
 
+        # Общая сессия процесса (src.core.http): TCP/TLS-соединения переиспользуются
+        # между запросами и клиентами. Заголовки передаём в каждом запросе —
+        # сессию делят и другие API.
+        self.session = SESSION
+
     def _post(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
         """
         Внутренний метод для отправки POST-запроса к Ozon API.
@@ -82,7 +95,7 @@ class OzonSellerClient:
         url = f"{self.BASE_URL}{path}"
 
         try:
-            response = requests.post(url, json=payload, headers=self.headers, timeout=30)
+            response = self.session.post(url, json=payload, headers=self.headers, timeout=30)
         except requests.RequestException as e:
             # Это ошибка уровня сети (нет интернета, DNS, таймаут и т.п.)
             raise OzonSellerAPIError(f"Ошибка сети при обращении к {url}: {e}")
@@ -95,7 +108,7 @@ class OzonSellerClient:
             )
 
         try:
-            data = response.json()
+            data = json_loads(response.content)
         except ValueError:
             # Если Ozon вернул невалидный JSON — тоже ошибка
             raise OzonSellerAPIError(
@@ -104,6 +117,68 @@ class OzonSellerClient:
 
         return data
 
+    def _fetch_postings_page(self, path: str, payload: Dict[str, Any], offset: int) -> List[Dict[str, Any]]:
+        """
+        Одна страница списка отправлений с заданным offset.
+        """
+        data = self._post(path, {**payload, "offset": offset})
+
+        # Структура ответа зависит от конкретного метода,
+        # но обычно внутри есть поле "result" с данными.
+        result = data.get("result")
+        if result is None:
+            raise OzonSellerAPIError(f"Неожиданная структура ответа: {data}")
+
+        # result может быть либо:
+        # - списком отправлений: [ {...}, {...}, ... ]
+        # - словарём с ключом "postings": {"postings": [ {...}, ... ], "has_next": true }
+        if isinstance(result, list):
+            return result
+        return result.get("postings", [])
+
+    def _iter_postings(self, path: str, payload: Dict[str, Any], limit: int) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Отдаёт отправления постранично, по порядку offset.
+
+        Общего количества API не отдаёт, поэтому идём "волнами":
+        сначала первая страница, и если она полная — следующие page_concurrency
+        страниц параллельно. Как только волна скачана целиком и вся полная,
+        следующая волна уходит в пул ещё до того, как мы отдадим страницы
+        текущей — пока вызывающий пишет их в БД, API уже качает дальше.
+        Останавливаемся на первой неполной странице.
+        """
+        batch = self._fetch_postings_page(path, payload, 0)
+        yield batch
+        if len(batch) < limit:
+            return
+
+        def submit_wave(pool: ThreadPoolExecutor, start: int):
+            return [
+                pool.submit(self._fetch_postings_page, path, payload, start + i * limit)
+                for i in range(self.page_concurrency)
+            ]
+
+        offset = limit
+        with ThreadPoolExecutor(max_workers=self.page_concurrency) as pool:
+            wave = submit_wave(pool, offset)
+            while wave:
+                batches = [f.result() for f in wave]
+                offset += self.page_concurrency * limit
+
+                # prefetch: следующая волна качается, пока обрабатываются страницы этой
+                has_more = all(len(b) == limit for b in batches)
+                wave = submit_wave(pool, offset) if has_more else None
+
+                for batch in batches:
+                    yield batch
+                    # Если вернулось меньше, чем limit — дальше страниц нет.
+                    if len(batch) < limit:
+                        return
+
+    def _fetch_postings(self, path: str, payload: Dict[str, Any], limit: int) -> List[Dict[str, Any]]:
+        """Выкачивает все страницы списка отправлений одним списком."""
+        return [p for batch in self._iter_postings(path, payload, limit) for p in batch]
+
     def get_postings_fbo(
         self,
         date_from: datetime,
@@ -132,7 +207,18 @@ class OzonSellerClient:
         Возвращает:
         - список словарей, каждый словарь — это одно отправление (posting).
         """
+        return [p for batch in self.iter_postings_fbo(date_from, date_to, limit) for p in batch]
 
+    def iter_postings_fbo(
+        self,
+        date_from: datetime,
+        date_to: datetime,
+        limit: int = 100
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        То же, что get_postings_fbo, но страницами по мере скачивания:
+        можно писать страницу в БД, пока следующие ещё качаются.
+        """
         # Преобразуем datetime в строку формата ISO 8601.
         # Например: "2024-01-01T00:00:00Z"
         since_str = date_from.strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -157,41 +243,7 @@ class OzonSellerClient:
             }
         }
 
-        postings: List[Dict[str, Any]] = []
-        offset = 0
-
-        while True:
-            payload["offset"] = offset
-
-            data = self._post("/v2/posting/fbo/list", payload)
-
-            # Структура ответа зависит от конкретного метода,
-            # но обычно внутри есть поле "result" с данными.
-            result = data.get("result")
-            if result is None:
-                raise OzonSellerAPIError(f"Неожиданная структура ответа: {data}")
-
-            # result может быть либо:
-            # - списком отправлений: [ {...}, {...}, ... ]
-            # - словарём с ключом "postings": {"postings": [ {...}, ... ], "has_next": true }
-            if isinstance(result, list):
-                batch = result
-            else:
-                batch = result.get("postings", [])
-
-            if not batch:
-                break
-
-            postings.extend(batch)
-
-            # Если вернулось меньше, чем limit — тоже можно завершать.
-            if len(batch) < limit:
-                break
-
-            # Иначе двигаем offset и продолжаем.
-            offset += limit
-
-        return postings
+        yield from self._iter_postings("/v2/posting/fbo/list", payload, limit)
     
     def get_postings_fbs(
         self,
@@ -246,41 +298,7 @@ class OzonSellerClient:
             }
         }
 
-        postings: List[Dict[str, Any]] = []
-        offset = 0
-
-        while True:
-            payload["offset"] = offset
-
-            data = self._post("/v3/posting/fbs/list", payload)
-
-            # Структура ответа зависит от конкретного метода,
-            # но обычно внутри есть поле "result" с данными.
-            result = data.get("result")
-            if result is None:
-                raise OzonSellerAPIError(f"Неожиданная структура ответа: {data}")
-
-            # result может быть либо:
-            # - списком отправлений: [ {...}, {...}, ... ]
-            # - словарём с ключом "postings": {"postings": [ {...}, ... ], "has_next": true }
-            if isinstance(result, list):
-                batch = result
-            else:
-                batch = result.get("postings", [])
-
-            if not batch:
-                break
-
-            postings.extend(batch)
-
-            # Если вернулось меньше, чем limit — тоже можно завершать.
-            if len(batch) < limit:
-                break
-
-            # Иначе двигаем offset и продолжаем.
-            offset += limit
-
-        return postings
+        return self._fetch_postings("/v3/posting/fbs/list", payload, limit)
 
 
 def get_default_seller_client() -> OzonSellerClient:
@@ -0,0 +1,39 @@
+# test/_ozon_auth.py
+"""
+Общее для ручных sample-скриптов Performance API:
+BASE, одна HTTP-сессия и get_token() через файловый кэш токена из archive/auth.py
+(PerformanceAuth — один кэш на все процессы, без своей копии здесь).
+"""
+
+import os
+import sys
+from pathlib import Path
+
+# скрипты запускаются как python test/<name>.py — корень репозитория добавляем сами
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from archive.auth import PerformanceAuth, get_session  # noqa: E402
+
+try:
+    from src.core.config import settings
+    CLIENT_ID = settings.OZON_PERF_CLIENT_ID
+    CLIENT_SECRET = settings.OZON_PERF_CLIENT_SECRET
+except ImportError:
+    # запуск без зависимостей src — берём из окружения
+    CLIENT_ID = os.getenv("OZON_PERF_CLIENT_ID")
+    CLIENT_SECRET = os.getenv("OZON_PERF_CLIENT_SECRET")
+
+BASE = "https://api-performance.ozon.ru"
+
+# одна сессия на процесс (та же, через которую PerformanceAuth ходит за токеном):
+# keep-alive, без TLS-handshake на каждый запрос; пул с запасом под параллельные пробы
+SESSION = get_session()
+
+_AUTH = PerformanceAuth(CLIENT_ID, CLIENT_SECRET)
+
+
+def get_token() -> str:
+    """Bearer-токен (из кэша, пока свежий) — и он же в заголовках SESSION."""
+    token = _AUTH.get_token()
+    SESSION.headers["Authorization"] = f"Bearer {token}"
+    return token
@@ -1,33 +1,111 @@
-import requests
-from ..config import settings
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
-BASE = "https://api-performance.ozon.ru"
+from _ozon_auth import BASE, SESSION, get_token  # соседний файл в test/
 
 UUID = "bf91821b-84c3-4b88-b1c8-e978ecf63341"
 
-def get_token():
-    r = requests.post(f"{BASE}/api/client/token", json={
-        "client_id": settings.OZON_PERF_CLIENT_ID,
-        "client_secret": settings.OZON_PERF_CLIENT_SECRET,
-        "grant_type": "client_credentials",
-    }, timeout=60)
-    r.raise_for_status()
-    return r.json()["access_token"]
-
-def try_get(token, path):
-    r = requests.get(f"{BASE}{path}", headers={"Authorization": f"Bearer {token}"}, timeout=60)
-    print("\nPATH:", path)
-    print("STATUS:", r.status_code)
-    print("BODY:", r.text[:2000])
-    return r
+MAX_ATTEMPTS = 5
+
+# варианты URL отчёта; какой сработал — запоминаем, и в следующий раз пробуем только его
+DEFAULT_PATHS = [
+    "/api/client/statistics/{uuid}",
+    "/api/client/statistics/result/{uuid}",
+    "/api/client/statistics/result?UUID={uuid}",
+    "/api/client/statistics/file/{uuid}",
+    "/api/client/statistics/download/{uuid}",
+    "/api/client/statistics/download?UUID={uuid}",
+]
+PATHS_CACHE = Path.home() / ".cache" / "ozon_perf_paths.json"
+
+def load_cached_paths() -> list[str]:
+    try:
+        with open(PATHS_CACHE, "r", encoding="utf-8") as f:
+            path = json.load(f).get("report")
+    except (OSError, ValueError):
+        return []
+    return [path] if path else []
+
+def save_cached_path(path: str) -> None:
+    try:
+        PATHS_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        with open(PATHS_CACHE, "w", encoding="utf-8") as f:
+            json.dump({"report": path}, f)
+    except OSError as e:
+        print(f"[paths_cache] не удалось сохранить: {e}")
+
+def _head(r, limit: int) -> str:
+    """Первые limit байт тела: остальное не качаем и не декодируем."""
+    with r:
+        prefix = next(r.iter_content(limit), b"")
+    return prefix.decode("utf-8", "replace")
+
+def _retry_delay(r, attempt: int) -> float:
+    """Retry-After от Ozon, если есть; иначе 0.5s → 1 → 2 ... не больше 30s."""
+    try:
+        return float(r.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return min(30.0, 0.5 * 2 ** attempt)
+
+def _pretty(text: str, limit: int = 2048) -> str:
+    """
+    Если в префиксе целый JSON — с отступами и без \\uXXXX (кириллица читается);
+    обрезанный/не-JSON ответ печатаем как есть.
+    """
+    try:
+        obj = json.loads(text)
+    except ValueError:
+        return text[:limit]
+    return json.dumps(obj, ensure_ascii=False, indent=2)[:limit]
+
+def try_get(path):
+    # 429 / 5xx — не долбим API, а ждём и повторяем
+    for attempt in range(MAX_ATTEMPTS):
+        r = SESSION.get(f"{BASE}{path}", timeout=60, stream=True)
+        if (r.status_code < 500 and r.status_code != 429) or attempt == MAX_ATTEMPTS - 1:
+            break
+        r.close()
+        time.sleep(_retry_delay(r, attempt))
+    # печатаем в основном потоке, по порядку путей
+    return path, r.status_code, _pretty(_head(r, 2048))
+
+def probe(templates):
+    """Все варианты URL сразу — пробы независимые; результаты в порядке templates."""
+    with ThreadPoolExecutor(max_workers=len(templates)) as ex:
+        return list(ex.map(lambda t: try_get(t.format(uuid=UUID)), templates))
+
+def poll(path, sleep_s: float = 3.0, max_wait_s: float = 300.0):
+    """
+    Ожидание готовности отчёта: один URL раз в sleep_s секунд, пока ответ 202
+    (отчёт ещё строится). Время ответа определяет сам отчёт, частые опросы не ускоряют.
+    """
+    started = time.time()
+    while True:
+        result = try_get(path)
+        if result[1] != 202 or time.time() - started > max_wait_s:
+            return result
+        time.sleep(sleep_s)
 
 if __name__ == "__main__":
-    token = get_token()
-
-    # 1) самые частые варианты
-    try_get(token, f"/api/client/statistics/{UUID}")
-    try_get(token, f"/api/client/statistics/result/{UUID}")
-    try_get(token, f"/api/client/statistics/result?UUID={UUID}")
-    try_get(token, f"/api/client/statistics/file/{UUID}")
-    try_get(token, f"/api/client/statistics/download/{UUID}")
-    try_get(token, f"/api/client/statistics/download?UUID={UUID}")
+    get_token()  # Bearer сразу в заголовках SESSION
+
+    # --rediscover — заново перебрать все варианты, не глядя в кэш
+    templates = [] if "--rediscover" in sys.argv[1:] else load_cached_paths()
+    results = probe(templates) if templates else []
+    if not results or not 200 <= results[0][1] < 300:
+        if results:
+            print("cached path failed, rediscovering...")
+        templates = DEFAULT_PATHS
+        results = probe(templates)
+
+    for path, status, body in results:
+        print("\nPATH:", path)
+        print("STATUS:", status)
+        print("BODY:", body)
+
+    winner = next((t for t, r in zip(templates, results) if 200 <= r[1] < 300), None)
+    if winner:
+        save_cached_path(winner)
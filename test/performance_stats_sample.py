@@ -1,62 +1,59 @@
 
-import os, requests, datetime as dt
-
-BASE = "https://api-performance.ozon.ru"
-CLIENT_ID = os.getenv("OZON_PERF_CLIENT_ID")
-CLIENT_SECRET = os.getenv("OZON_PERF_CLIENT_SECRET")
-
-def get_token():
-    r = requests.post(f"{BASE}/api/client/token", json={
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "grant_type": "client_credentials",
-    }, timeout=30)
-    r.raise_for_status()
-    return r.json()["access_token"]
-
-def stats_sample(token):
+import datetime as dt
+import os
+
+from _ozon_auth import BASE, SESSION, get_token  # соседний файл в test/
+
+def _head(r, limit: int) -> str:
+    """Первые limit байт тела: остальное не качаем и не декодируем."""
+    with r:
+        prefix = next(r.iter_content(limit), b"")
+    return prefix.decode("utf-8", "replace")
+
+def _period_iso(days: int = 60) -> tuple[str, str]:
+    """(from, to) последних days дней в ISO — считаем один раз на запуск."""
     to_date = dt.date.today()
-    from_date = to_date - dt.timedelta(days=60)
+    return (to_date - dt.timedelta(days=days)).isoformat(), to_date.isoformat()
 
+def stats_sample(from_iso: str, to_iso: str):
     payload = {
-        "dateFrom": str(from_date),
-        "dateTo": str(to_date),
+        "dateFrom": from_iso,
+        "dateTo": to_iso,
         "campaigns": ["18179987"],
         "groupBy": "DATE",  # если не так — API скажет, как правильно
         # "metrics": ["IMPRESSIONS", "CLICKS", "SPENT", "ORDERS"]  # тоже может отличаться
     }
 
-    r = requests.post(
+    r = SESSION.post(
         f"{BASE}/api/client/statistics/json",
-        headers={"Authorization": f"Bearer {token}"},
         json=payload,
-        timeout=60
+        timeout=60,
+        stream=True,
     )
-    print(r.request.body)
+    if os.environ.get("OZON_DEBUG"):
+        print(r.request.body[:512])
     print("STATUS:", r.status_code)
-    print(r.text)
+    print(_head(r, 2048))
 
-def stats_attr(token, from_date, to_date, campaign_ids):
+def stats_attr(from_iso: str, to_iso: str, campaign_ids):
     payload = {
-        "dateFrom": str(from_date),
-        "dateTo": str(to_date),
+        "dateFrom": from_iso,
+        "dateTo": to_iso,
         "campaigns": campaign_ids,
         "groupBy": "DATE",
     }
-    r = requests.post(
+    r = SESSION.post(
         f"{BASE}/api/client/statistics/attribution/json",
-        headers={"Authorization": f"Bearer {token}"},
         json=payload,
-        timeout=60
+        timeout=60,
+        stream=True,
     )
-    print("campaigns:", campaign_ids, "status:", r.status_code, "body:", r.text[:300])
+    print("campaigns:", campaign_ids, "status:", r.status_code, "body:", _head(r, 300))
 
 if __name__ == "__main__":
-    t = get_token()
-    to_date = dt.date.today()
-    from_date = to_date - dt.timedelta(days=60)
+    get_token()  # Bearer сразу в заголовках SESSION
+    from_iso, to_iso = _period_iso()
 
-    # тест по одной
-    stats_attr(t, from_date, to_date, ["18179987"])
-    stats_attr(t, from_date, to_date, ["18179988"])
+    # campaigns — массив: обе кампании одним запросом
+    stats_attr(from_iso, to_iso, ["18179987", "18179988"])
 